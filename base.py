@@ -1,50 +1,336 @@
 import abc
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
 import functools
 import multiprocessing as mp
+import multiprocessing.pool
+import queue
+import threading
 import time
-from typing import Optional, List, Tuple
+import urllib.parse
+from typing import (
+    Callable, Iterable, Iterator, Optional, List, Sized, Tuple, Union)
 
-import bs4
 import pandas as pd
 import requests
 import os
 import string
-import joblib
 from tqdm.auto import tqdm
 
+from scrapers.attorneys import metrics, profiling
+from scrapers.attorneys.concurrency import (
+    acquire_slot, acquire_slot_async, adaptive_limit_stats,
+    configure_adaptive_limits)
+from scrapers.attorneys.frames import (
+    FrameWriter, KeyIndex, dump_cache_frame, load_cache_frame, write_frame)
+from scrapers.attorneys.httpcache import (
+    conditional_headers, configure_response_cache, get_response_cache,
+    request_url)
+from scrapers.attorneys.prefixes import PrefixIndex, search_prefixes
+from scrapers.attorneys.ratelimit import (
+    RateLimit, configure_rate_limits, parse_rate_limit, rate_limit_stats,
+    throttle,
+    throttle_async)
+from scrapers.attorneys.retry import (
+    FetchError, FetchFailure, RetryPolicy, get_retry_policy, parse_retry_after)
+from scrapers.attorneys.store import DetailsStore
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 letters = list(string.ascii_lowercase)
 
+# A worker count, or 'threads:N' to run the workers on a pool of N threads
+Processes = Optional[Union[int, str]]
+
+# Pool that open_pool hands out instead of opening one, set per thread
+# by the multi-state runner sharing one pool between scrapers
+_shared_pool = threading.local()
+
+# Keep-alive sessions, one per host for each worker thread. The pid guards
+# against reusing sockets a forked worker inherited from its parent.
+_sessions = threading.local()
+
+
+def get_session(url) -> requests.Session:
+    """Returns the calling worker's keep-alive session for the host of url"""
+    host = urllib.parse.urlsplit(url).netloc
+    if getattr(_sessions, 'pid', None) != os.getpid():
+        _sessions.pid, _sessions.by_host = os.getpid(), {}
+    session = _sessions.by_host.get(host)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=1)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _sessions.by_host[host] = session
+    return session
+
+
+def _thread_count(processes: Processes) -> Optional[int]:
+    if isinstance(processes, str) and processes.startswith('threads:'):
+        return int(processes[len('threads:'):])
+    return None
+
+
+def _init_worker():
+    """Initializer of the process pools, for the worker's metrics and profile"""
+    metrics.init_worker()
+    profiling.init_worker()
 
-def safe_get_soup(url, logfile=None, **kwargs):
+
+@contextlib.contextmanager
+def run_stage(name):
+    """Times stage name in the metrics and tags its profile samples"""
+    with metrics.stage(name), profiling.stage(name):
+        yield
+
+
+class _ClosingPool(mp.pool.Pool):
+    """
+    Process pool that lets its workers exit on their own when its block
+    completes, so that their exit handlers run, and only terminates them
+    when the block raises
+    """
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.terminate()
+            return
+        self.close()
+        self.join()
+
+
+@contextlib.contextmanager
+def use_pool(pool, executor: Optional[concurrent.futures.Executor] = None):
+    """
+    Makes `open_pool` return pool in the calling thread, whose blocks
+    must leave it open for the other threads, and the asyncio engine
+    parse on executor rather than on one of its own
+    """
+    _shared_pool.pool, _shared_pool.executor = pool, executor
     try:
-        with requests.get(url, timeout=5, **kwargs) as resp:
-            soup = bs4.BeautifulSoup(resp.content, features='lxml')
-            return soup
-    except Exception as ex:
-        print(f'encountered {ex}, when fetching {url}', file=logfile)
-        print('sleeping for five seconds...', file=logfile)
-        time.sleep(5)
-    return safe_get_soup(url, logfile=logfile)
+        yield
+    finally:
+        _shared_pool.pool, _shared_pool.executor = None, None
+
+
+def open_pool(processes: Processes) -> mp.pool.Pool:
+    """Opens a process pool, or a thread pool for a 'threads:N' spec"""
+    shared = getattr(_shared_pool, 'pool', None)
+    if shared is not None:
+        return shared
+    threads = _thread_count(processes)
+    if threads is not None:
+        return mp.pool.ThreadPool(processes=threads)
+    return _ClosingPool(processes=processes, initializer=_init_worker,
+                        context=mp.get_context())
+
+
+def open_executor(processes: Processes) -> concurrent.futures.Executor:
+    """`open_pool` counterpart returning a concurrent.futures executor"""
+    threads = _thread_count(processes)
+    if threads is not None:
+        return concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, initializer=_init_worker)
+
+
+def process_rss_mb(pid) -> float:
+    """Resident memory of pid and its descendants, read from /proc"""
+    total, pids = 0, [pid]
+    while len(pids) > 0:
+        pid = pids.pop()
+        try:
+            with open(f'/proc/{pid}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+            # Children are listed under the thread that started them
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children') as children:
+                    pids.extend(int(child)
+                                for child in children.read().split())
+        except (OSError, ValueError):
+            continue
+    return total / 1024
+
+
+def safe_get_content(url, logfile=None, retry_policy: Optional[RetryPolicy] = None,
+                     **kwargs) -> bytes:
+    """
+    Fetches url, retrying failures as per the retry policy.
+    Raises FetchError once the policy runs out of attempts.
+    Goes through the response cache when one is configured.
+    """
+    policy = retry_policy or get_retry_policy()
+    host = urllib.parse.urlsplit(url).netloc
+    cache, cached, cache_url = _cached_response(url, kwargs)
+    if cached is not None and cache.is_fresh(cached):
+        metrics.inc('response_cache_hits_total', host=host)
+        return cached.content
+    for attempt in range(1, policy.max_attempts + 1):
+        while (wait := policy.breaker.wait_time(host)) > 0:
+            time.sleep(wait)
+        throttle(url)
+        retry_after = None
+        slot = acquire_slot(url)
+        started = time.perf_counter()
+        try:
+            with get_session(url).get(url, timeout=5, **kwargs) as resp:
+                slot.done(resp.status_code)
+                _record_response(host, resp.status_code, len(resp.content),
+                                 started)
+                if resp.status_code not in policy.retry_statuses:
+                    policy.breaker.record_success(host)
+                    if cache is None:
+                        return resp.content
+                    _record_cache_use(host, resp.status_code)
+                    return cache.update(cache_url, cached, resp.status_code,
+                                        resp.content, resp.headers)
+                error = f'HTTP {resp.status_code}'
+                retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+        except Exception as ex:
+            slot.done(None)
+            _record_response(host, 'error', 0, started)
+            error = repr(ex)
+        policy.breaker.record_failure(host)
+        print(f'encountered {error}, when fetching {url}', file=logfile)
+        if attempt < policy.max_attempts:
+            metrics.inc('retries_total', host=host)
+            delay = policy.delay(attempt, retry_after)
+            print(f'sleeping for {delay:.1f} seconds...', file=logfile)
+            time.sleep(delay)
+    metrics.inc('failures_total', host=host)
+    raise FetchError(FetchFailure(url, error, policy.max_attempts))
+
+
+def _record_response(host, status, size: int, started: float):
+    """Records the latency, status and size of a response in the metrics"""
+    metrics.observe('request_seconds', time.perf_counter() - started,
+                    host=host)
+    metrics.inc('requests_total', host=host, status=status)
+    metrics.inc('bytes_total', size, host=host)
+
+
+def _record_cache_use(host, status):
+    # A 304 revalidates the cached body, anything else replaces it
+    if status == 304:
+        metrics.inc('response_cache_hits_total', host=host)
+    else:
+        metrics.inc('response_cache_misses_total', host=host)
+
+
+def _cached_response(url, kwargs: dict):
+    """
+    Returns the response cache, the cached response of the request and
+    its cache url, adding the revalidation headers to the request kwargs.
+    Raises FetchError for a request missing from a replay-only cache.
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return None, None, None
+    cache_url = request_url(url, kwargs.get('params'))
+    cached = cache.get(cache_url)
+    if cache.replay and cached is None:
+        raise FetchError(FetchFailure(url, 'not in the response cache', 0))
+    if cached is not None:
+        kwargs['headers'] = {**(kwargs.get('headers') or {}),
+                             **conditional_headers(cached)}
+    return cache, cached, cache_url
+
+
+async def async_get_content(session, url, logfile=None,
+                            retry_policy: Optional[RetryPolicy] = None,
+                            **kwargs) -> bytes:
+    """Asyncio counterpart of `safe_get_content` on an aiohttp session"""
+    policy = retry_policy or get_retry_policy()
+    host = urllib.parse.urlsplit(url).netloc
+    cache, cached, cache_url = _cached_response(url, kwargs)
+    if cached is not None and cache.is_fresh(cached):
+        metrics.inc('response_cache_hits_total', host=host)
+        return cached.content
+    timeout = aiohttp.ClientTimeout(total=5)
+    for attempt in range(1, policy.max_attempts + 1):
+        while (wait := policy.breaker.wait_time(host)) > 0:
+            await asyncio.sleep(wait)
+        await throttle_async(url)
+        retry_after = None
+        slot = await acquire_slot_async(url)
+        started = time.perf_counter()
+        try:
+            async with session.get(url, timeout=timeout, **kwargs) as resp:
+                content = await resp.read()
+                slot.done(resp.status)
+                _record_response(host, resp.status, len(content), started)
+                if resp.status not in policy.retry_statuses:
+                    policy.breaker.record_success(host)
+                    if cache is None:
+                        return content
+                    _record_cache_use(host, resp.status)
+                    return cache.update(cache_url, cached, resp.status,
+                                        content, resp.headers)
+                error = f'HTTP {resp.status}'
+                retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+        except Exception as ex:
+            slot.done(None)
+            _record_response(host, 'error', 0, started)
+            error = repr(ex)
+        policy.breaker.record_failure(host)
+        print(f'encountered {error}, when fetching {url}', file=logfile)
+        if attempt < policy.max_attempts:
+            metrics.inc('retries_total', host=host)
+            delay = policy.delay(attempt, retry_after)
+            print(f'sleeping for {delay:.1f} seconds...', file=logfile)
+            await asyncio.sleep(delay)
+    metrics.inc('failures_total', host=host)
+    raise FetchError(FetchFailure(url, error, policy.max_attempts))
 
 
 class ListScraper(abc.ABC):
+    # Identifies an attorney across runs
+    key_column = 'href'
+    # Listing columns whose change means the details need a re-fetch
+    watch_columns: List[str] = []
+
     @abc.abstractmethod
     def list_attorneys(self) -> pd.DataFrame:
         """Generates the list of attorneys for the given source"""
 
-    def _cache_load_term_frame(self, term) -> Optional[pd.DataFrame]:
-        term_frame_path = os.path.join(self._cache_path, f'{term}.pkl')
-        if not os.path.exists(term_frame_path):
+    def iter_frames(self) -> Iterator[pd.DataFrame]:
+        """Yields partial attorney frames as soon as they are listed"""
+        yield self.list_attorneys()
+
+    def work_units(self) -> List[str]:
+        """Independent parts of the listing, see `list_unit`"""
+        return ['all']
+
+    def list_unit(self, unit) -> pd.DataFrame:
+        """Lists one of the work units, which may run on other nodes"""
+        return self.list_attorneys()
+
+    def _cache_load_term_frame(self, term, columns: Optional[List[str]] = None
+                               ) -> Optional[pd.DataFrame]:
+        if self._refresh:
             return None
-        frame = pd.read_pickle(term_frame_path)
+        frame = load_cache_frame(os.path.join(self._cache_path, str(term)),
+                                 columns=columns)
+        metrics.inc('frame_cache_misses_total' if frame is None
+                    else 'frame_cache_hits_total')
         return frame
 
     def _cache_dump_term_frame(self, term, frame: pd.DataFrame):
-        term_frame_path = os.path.join(self._cache_path, f'{term}.pkl')
-        return frame.to_pickle(term_frame_path)
+        return dump_cache_frame(frame, os.path.join(self._cache_path, str(term)))
 
-    def __init__(self, cache_path, **kwargs):
+    def __init__(self, cache_path, refresh: bool = False, **kwargs):
         self._cache_path = cache_path
+        # Ignores the cached frames, listing everything again
+        self._refresh = refresh
         if not os.path.exists(self._cache_path):
             os.mkdir(self._cache_path)
 
@@ -61,67 +347,577 @@ class DetailsScraper(abc.ABC):
         Returns the details in the (page_url, details_dict) format
         """
 
-    def _cache_load_term_frame(self, term) -> Optional[pd.DataFrame]:
-        term_frame_path = os.path.join(self._cache_path, f'{term}.pkl')
-        if not os.path.exists(term_frame_path):
-            return None
-        frame = pd.read_pickle(term_frame_path)
-        return frame
+    def _page_fetch_url(self, page_url) -> str:
+        """Returns the absolute url the asyncio engine fetches for page_url"""
+        return page_url
 
-    def _cache_dump_term_frame(self, term, frame: pd.DataFrame):
-        term_frame_path = os.path.join(self._cache_path, f'{term}.pkl')
-        return frame.to_pickle(term_frame_path)
+    def _parse_page_details(self, page_url, content: bytes) -> Tuple[str, dict]:
+        """
+        Parses attorney details from the raw page content, which lets the
+        asyncio and pipelined engines parse pages apart from fetching them.
+        Without it, they fetch and parse each page with `_page_details`
+        on their fetch threads.
+        """
+        raise NotImplementedError(
+            f'{type(self).__name__} only parses pages it fetches itself')
+
+    def _parses_content(self) -> bool:
+        """Whether `_parse_page_details` is implemented"""
+        return (type(self)._parse_page_details
+                is not DetailsScraper._parse_page_details)
 
     def fetch_details(self, attorneys: pd.DataFrame) -> pd.DataFrame:
         """Fetch details about each row in `attorneys`"""
-        attorneys_hash = joblib.hash(attorneys)
-        cached_details = self._cache_load_term_frame(attorneys_hash)
-        if cached_details is not None:
-            return cached_details
-
         page_urls = self._list_urls(attorneys)
-        page_list, details_list = [], []
-        if self._processes is not None:
-            with mp.Pool(processes=mp.cpu_count()) as pool:
-                for page, page_details in tqdm( 
-                        pool.imap_unordered(self._page_details, page_urls), total=len(page_urls)):
-                    details_list.append(page_details)
-                    page_list.append(page)
+        with DetailsStore(self._store_path) as store:
+            done = store.done_urls()
+            pending = [page for page in dict.fromkeys(page_urls)
+                       if page not in done]
+            for _ in self._iter_details(pending, store):
+                pass
+            return store.frame(page_urls)
+
+    def _iter_details(self, page_urls: Iterable[str], store: DetailsStore,
+                      on_result: Optional[Callable[[str], None]] = None
+                      ) -> Iterator[Tuple[str, dict]]:
+        """
+        Fetches page_urls into the store, yielding the details as they
+        arrive. Failed pages are re-queued after each pass, and those
+        still failing after `self._requeue_rounds` are recorded instead.
+        on_result is called with every page the workers are done with,
+        whether it failed or not.
+        """
+        pending = page_urls
+        # Pages recorded as failed by an earlier run, fetched again now
+        failed_before, recovered = store.failed_urls(), 0
+        for _ in range(1 + self._requeue_rounds):
+            failures = []
+            for page, page_details in self._iter_results(pending):
+                if on_result is not None:
+                    on_result(page)
+                if isinstance(page_details, FetchFailure):
+                    failures.append((page, page_details))
+                    continue
+                store.put(page, page_details)
+                recovered += page in failed_before
+                yield page, page_details
+            if len(failures) == 0:
+                break
+            pending = [page for page, _ in failures]
+
+        for page, failure in failures:
+            store.put_failure(page, failure)
+        if len(failures) > 0:
+            print(f'failed to fetch {len(failures)} pages, '
+                  f'they are retried on the next run')
+        if recovered > 0:
+            print(f'fetched {recovered} pages that failed on an earlier run')
+
+    def _safe_page_details(self, page_url) -> Tuple[str, Union[dict, FetchFailure]]:
+        """`_page_details` returning a FetchFailure instead of raising"""
+        try:
+            return self._page_details(page_url)
+        except FetchError as ex:
+            return page_url, ex.failure
+
+    def _iter_results(self, page_urls: Iterable[str]
+                      ) -> Iterator[Tuple[str, Union[dict, FetchFailure]]]:
+        """
+        Yields (page, details or FetchFailure) for page_urls in completion
+        order. page_urls may be a lazy iterable that blocks for new urls.
+        """
+        total = len(page_urls) if isinstance(page_urls, Sized) else None
+        if self._concurrency is not None:
+            yield from tqdm(self._iter_results_async(page_urls), total=total)
+        elif self._fetch_threads is not None:
+            yield from tqdm(self._iter_results_pipelined(page_urls),
+                            total=total)
+        elif self._processes is not None:
+            with open_pool(self._processes) as pool:
+                yield from tqdm(
+                    pool.imap_unordered(self._safe_page_details, page_urls),
+                    total=total)
         else:
-            for page in tqdm(page_urls):
-                page_details = self._page_details(page)
-                details_list.append(page_details)
-                page_list.append(page)
+            for page in tqdm(page_urls, total=total):
+                yield self._safe_page_details(page)
+
+    def _iter_results_pipelined(self, page_urls: Iterable[str]):
+        """
+        Fetches the pages on `self._fetch_threads` threads and parses them
+        on the process pool, or on one thread if processes are disabled.
+        Fetched pages wait for the parsers in a bounded queue, which holds
+        the fetchers back whenever parsing falls behind. Scrapers without
+        `_parse_page_details` are fetched and parsed on the fetch threads.
+        """
+        workers = _thread_count(self._processes) or self._processes or 1
+        parses_content = self._parses_content()
+        urls, urls_lock = iter(page_urls), threading.Lock()
+        raw_pages, results = queue.Queue(maxsize=2 * workers), queue.Queue()
+        stopped, done = threading.Event(), object()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    return raw_pages.put(item, timeout=1)
+                except queue.Full:
+                    pass
+
+        def get():
+            while not stopped.is_set():
+                try:
+                    return raw_pages.get(timeout=1)
+                except queue.Empty:
+                    pass
+            return done
+
+        def fetch():
+            try:
+                with profiling.stage('fetch'):
+                    while not stopped.is_set():
+                        with urls_lock:
+                            page_url = next(urls, None)
+                        if page_url is None:
+                            break
+                        if not parses_content:
+                            with request_slot():
+                                results.put(self._safe_page_details(page_url))
+                            continue
+                        try:
+                            with request_slot():
+                                content = safe_get_content(
+                                    self._page_fetch_url(page_url))
+                        except FetchError as ex:
+                            results.put((page_url, ex.failure))
+                        else:
+                            put((page_url, content))
+            except BaseException as ex:
+                results.put(ex)
+            put(done)
+
+        def parse(pool):
+            try:
+                dispatch(pool)
+            except BaseException as ex:
+                results.put(ex)
+
+        def dispatch(pool):
+            # Parses queued on the pool, beyond which pages stay in raw_pages
+            slots = threading.Semaphore(2 * workers)
+
+            def take_slot() -> bool:
+                while not slots.acquire(timeout=1):
+                    if stopped.is_set():
+                        return False
+                return True
+
+            def on_parsed(result):
+                slots.release()
+                results.put(result)
+
+            fetching = self._fetch_threads
+            while fetching > 0:
+                item = get()
+                if item is done:
+                    fetching -= 1
+                elif pool is None:
+                    try:
+                        results.put(self._parse_page_details(*item))
+                    except Exception as ex:
+                        results.put(ex)
+                elif take_slot():
+                    pool.apply_async(self._parse_page_details, item,
+                                     callback=on_parsed,
+                                     error_callback=on_parsed)
+            # Waits for the last parses by taking back all their slots
+            if all(take_slot() for _ in range(2 * workers)):
+                results.put(done)
+
+        with contextlib.ExitStack() as stack:
+            pool, request_slot = None, contextlib.nullcontext
+            if self._processes is not None:
+                pool = stack.enter_context(open_pool(self._processes))
+            if hasattr(pool, 'request_slot'):
+                # A pool view of the multi-state runner, whose host limits
+                # then apply to the requests rather than the parse tasks
+                request_slot, pool = pool.request_slot, pool.parse_view()
+            threads = [threading.Thread(target=fetch, daemon=True)
+                       for _ in range(self._fetch_threads)]
+            threads.append(threading.Thread(target=parse, args=(pool,),
+                                            daemon=True))
+            for thread in threads:
+                thread.start()
+            try:
+                for result in iter(results.get, done):
+                    if isinstance(result, BaseException):
+                        raise result
+                    yield result
+            finally:
+                stopped.set()
+
+    def _iter_results_async(self, page_urls: Iterable[str]):
+        """Runs the asyncio engine on its own thread, yielding its results"""
+        results = queue.Queue()
+        done = object()
+        # Read here, the engine thread does not see the caller's pools
+        parse_pool = getattr(_shared_pool, 'executor', None)
+
+        def run():
+            try:
+                asyncio.run(self._fetch_details_async(
+                    page_urls, results.put, parse_pool))
+            except BaseException as ex:
+                results.put(ex)
+            results.put(done)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        for result in iter(results.get, done):
+            if isinstance(result, BaseException):
+                raise result
+            yield result
+        thread.join()
+
+    async def _fetch_details_async(self, page_urls, on_result,
+                                   parse_pool=None):
+        """
+        Fetches the pages with `self._concurrency` requests in flight and
+        parses them separately, on parse_pool or a process pool of its own
+        if processes are enabled.
+        Fetching goes on while pages are parsed, up to two pages waiting
+        per parse worker. Scrapers without `_parse_page_details` are
+        fetched and parsed together on `self._concurrency` threads.
+        """
+        if aiohttp is None:
+            raise ImportError('the asyncio engine requires aiohttp')
+
+        loop = asyncio.get_running_loop()
+        # page_urls may block, so it is drained on a thread into a queue
+        urls_queue = asyncio.Queue(maxsize=2 * self._concurrency)
+        stopped, feed_errors = threading.Event(), []
+
+        def put(item):
+            future = asyncio.run_coroutine_threadsafe(urls_queue.put(item), loop)
+            while not stopped.is_set():
+                try:
+                    return future.result(timeout=1)
+                except concurrent.futures.TimeoutError:
+                    pass
+            future.cancel()
+
+        def feed():
+            try:
+                for page_url in page_urls:
+                    put(page_url)
+            except BaseException as ex:
+                feed_errors.append(ex)
+            for _ in range(self._concurrency):
+                put(None)
+
+        workers = _thread_count(self._processes) or self._processes or 1
+        parse_slots, parses = asyncio.Semaphore(2 * workers), set()
 
-        details = pd.DataFrame(details_list, index=page_list)
+        async def parse(parse_pool, page_url, content):
+            try:
+                on_result(await loop.run_in_executor(
+                    parse_pool, self._parse_page_details, page_url, content))
+            except Exception as ex:
+                on_result(ex)
+            finally:
+                parse_slots.release()
 
-        self._cache_dump_term_frame(attorneys_hash, details)
-        return details
+        async def fetch_and_parse(page_url):
+            try:
+                on_result(await loop.run_in_executor(
+                    fetch_pool, self._safe_page_details, page_url))
+            except Exception as ex:
+                on_result(ex)
 
-    def __init__(self, cache_path, processes: Optional[int] = None):
+        async def worker(session, parse_pool):
+            while (page_url := await urls_queue.get()) is not None:
+                if fetch_pool is not None:
+                    await fetch_and_parse(page_url)
+                    continue
+                try:
+                    content = await async_get_content(
+                        session, self._page_fetch_url(page_url))
+                except FetchError as ex:
+                    on_result((page_url, ex.failure))
+                    continue
+                await parse_slots.acquire()
+                task = asyncio.create_task(parse(parse_pool, page_url, content))
+                parses.add(task)
+                task.add_done_callback(parses.discard)
+
+        own_pool, fetch_pool = None, None
+        if not self._parses_content():
+            # Pages are fetched and parsed together, one per thread
+            fetch_pool = concurrent.futures.ThreadPoolExecutor(
+                self._concurrency)
+        elif parse_pool is None and self._processes is not None:
+            parse_pool = own_pool = open_executor(self._processes)
+        connector = aiohttp.TCPConnector(limit=self._concurrency)
+        feeder = threading.Thread(target=feed, daemon=True)
+        try:
+            async with aiohttp.ClientSession(connector=connector) as session:
+                feeder.start()
+                await asyncio.gather(*(worker(session, parse_pool)
+                                       for _ in range(self._concurrency)))
+                await asyncio.gather(*parses)
+        finally:
+            stopped.set()
+            for pool in (own_pool, fetch_pool):
+                if pool is not None:
+                    pool.shutdown()
+        if len(feed_errors) > 0:
+            raise feed_errors[0]
+
+    def __init__(self, cache_path, processes: Processes = None,
+                 concurrency: Optional[int] = None,
+                 fetch_threads: Optional[int] = None, requeue_rounds: int = 1):
         self._cache_path = cache_path
+        self._store_path = os.path.join(cache_path, 'details.sqlite')
         self._processes = processes
+        # Number of requests in flight for the asyncio engine, which is
+        # used instead of the process pool whenever it is set
+        self._concurrency = concurrency
+        # Threads fetching pages for the processes to parse, which then
+        # only parse, unless the asyncio engine is used
+        self._fetch_threads = fetch_threads
+        # Failed pages are re-queued after a full pass instead of blocking
+        # a worker, this many times per run
+        self._requeue_rounds = requeue_rounds
 
 
 class AttorneysScraper(abc.ABC):
     @staticmethod
     def combine_details(attorneys: pd.DataFrame,
                         details: pd.DataFrame) -> pd.DataFrame:
-        return attorneys.join(details)
+        return attorneys.join(details, on='href')
 
     def scrape(self):
-        attorneys = self._list_scraper.list_attorneys()
-        details = self._details_scraper.fetch_details(attorneys)
-        combined = self.combine_details(attorneys, details)
+        if self._incremental:
+            return self._scrape_incremental()
+        with run_stage('list'):
+            attorneys = self._list_scraper.list_attorneys()
+        with run_stage('details'):
+            details = self._details_scraper.fetch_details(attorneys)
+        with run_stage('combine'):
+            combined = self.combine_details(attorneys, details)
+        self.report_rate_limits()
+        return combined
+
+    def _scrape_incremental(self) -> pd.DataFrame:
+        """
+        Lists all attorneys again but only fetches the details of new
+        attorneys, of those whose watched listing columns changed since
+        the previous snapshot and of those older than `self._max_age`.
+        The result is merged into the previous snapshot.
+        """
+        key = self._list_scraper.key_column
+        previous = self._load_snapshot()
+        with run_stage('list'):
+            attorneys = self._list_scraper.list_attorneys()
+
+        with DetailsStore(self._details_scraper._store_path) as store:
+            if previous is not None:
+                changed = self._changed_attorneys(previous, attorneys)
+                store.discard(self._details_scraper._list_urls(changed))
+                print(f'{len(changed)} attorneys changed since the last run')
+            if self._max_age is not None:
+                expired = store.discard_older_than(
+                    time.time() - self._max_age * 24 * 3600)
+                print(f'{expired} details are older than {self._max_age} days')
+
+        with run_stage('details'):
+            details = self._details_scraper.fetch_details(attorneys)
+        with run_stage('combine'):
+            combined = self.combine_details(attorneys, details)
+            if previous is not None:
+                kept = previous[~previous[key].isin(combined[key])]
+                combined = pd.concat([combined, kept], ignore_index=True)
+            self._dump_snapshot(combined)
+        self.report_rate_limits()
         return combined
 
+    def _changed_attorneys(self, previous: pd.DataFrame,
+                           attorneys: pd.DataFrame) -> pd.DataFrame:
+        """Returns the attorneys whose watched columns differ from previous"""
+        key = self._list_scraper.key_column
+        watched = [column for column in self._list_scraper.watch_columns
+                   if column in attorneys.columns and column in previous.columns]
+        merged = attorneys[[key] + watched].merge(
+            previous[[key] + watched].drop_duplicates(subset=[key]),
+            on=key, suffixes=('', '_previous'))
+        changed = pd.Series(False, index=merged.index)
+        for column in watched:
+            changed |= (merged[column].fillna('').astype(str)
+                        != merged[column + '_previous'].fillna('').astype(str))
+        return attorneys[attorneys[key].isin(merged.loc[changed, key])]
+
+    def _load_snapshot(self) -> Optional[pd.DataFrame]:
+        return load_cache_frame(self._snapshot_path)
+
+    def _dump_snapshot(self, combined: pd.DataFrame):
+        dump_cache_frame(combined, self._snapshot_path)
+
+    def scrape_iter(self, chunk_size: int = 1000) -> Iterator[pd.DataFrame]:
+        """
+        Streams the combined frame in chunks, overlapping listing and
+        details: the new hrefs of every listed frame go straight to the
+        details workers, and rows are combined once their details arrive.
+        Listing waits while chunk_size of its pages are being fetched, or
+        chunk_size rows wait to be combined, which bounds the rows held.
+        """
+        if self._incremental:
+            raise ValueError('incremental refresh does not support streaming')
+        details_scraper = self._details_scraper
+        # Rows ready to combine, from the listing when their details are
+        # stored already and from the details workers otherwise
+        rows_queue, urls_queue = queue.Queue(maxsize=chunk_size), queue.Queue()
+        # Listed pages the details workers have not finished yet
+        fetch_slots, fetching = threading.Semaphore(chunk_size), set()
+        waiting, errors = {}, []
+        stopped, finished = threading.Event(), object()
+
+        def put(row):
+            while not stopped.is_set():
+                try:
+                    return rows_queue.put(row, timeout=1)
+                except queue.Full:
+                    pass
+
+        def take_slot() -> bool:
+            while not fetch_slots.acquire(timeout=1):
+                if stopped.is_set():
+                    return False
+            return True
+
+        def list_frames(done):
+            seen = KeyIndex()
+            try:
+                for frame in self._list_scraper.iter_frames():
+                    frame = frame.loc[[seen.add(href) for href in frame['href']]]
+                    fetched = set(details_scraper._list_urls(frame)) - done
+                    for row in frame.to_dict('records'):
+                        if row['href'] not in fetched:
+                            put(row)
+                        elif take_slot():
+                            fetching.add(row['href'])
+                            waiting[row['href']] = row
+                            urls_queue.put(row['href'])
+                    if stopped.is_set():
+                        break
+            except BaseException as ex:
+                errors.append(ex)
+            urls_queue.put(None)
+            put(finished)
+
+        def release(page):
+            if page in fetching:
+                fetching.discard(page)
+                fetch_slots.release()
+
+        def fetch_details():
+            try:
+                # A connection of its own, as SQLite's are per thread
+                with DetailsStore(details_scraper._store_path) as store:
+                    for page, _ in details_scraper._iter_details(
+                            iter(urls_queue.get, None), store,
+                            on_result=release):
+                        put(waiting.pop(page))
+                # Pages that failed to fetch, combined without details
+                for page in list(waiting):
+                    put(waiting.pop(page))
+            except BaseException as ex:
+                errors.append(ex)
+            put(finished)
+
+        with DetailsStore(details_scraper._store_path) as store:
+            threads = [threading.Thread(target=list_frames,
+                                        args=(store.done_urls(),), daemon=True),
+                       threading.Thread(target=fetch_details, daemon=True)]
+            for thread in threads:
+                thread.start()
+            try:
+                rows, running = [], len(threads)
+                while running > 0:
+                    row = rows_queue.get()
+                    if row is finished:
+                        running -= 1
+                        if len(errors) > 0:
+                            raise errors[0]
+                        continue
+                    rows.append(row)
+                    if len(rows) >= chunk_size:
+                        yield self._combine_rows(rows, store)
+                        rows = []
+                if len(rows) > 0:
+                    yield self._combine_rows(rows, store)
+            finally:
+                stopped.set()
+        self.report_rate_limits()
+
+    def _combine_rows(self, rows: List[dict], store: DetailsStore) -> pd.DataFrame:
+        attorneys = pd.DataFrame(rows)
+        details = store.frame(attorneys['href'])
+        return self.combine_details(attorneys, details)
+
+    def write_stream(self, output, chunk_size: int = 1000):
+        """
+        Writes the output chunk by chunk while scraping, as parquet row
+        groups when output ends with .parquet, json lines when it ends
+        with .jsonl, csv otherwise
+        """
+        with run_stage('stream'), FrameWriter(output, key='href') as writer:
+            for chunk in self.scrape_iter(chunk_size=chunk_size):
+                writer.write(chunk)
+
+    @staticmethod
+    def report_rate_limits(logfile=None):
+        for host, stats in rate_limit_stats().items():
+            print(f'{host}: {stats["requests"]} requests waited '
+                  f'{stats["waited"]:.1f} seconds for the rate limit',
+                  file=logfile)
+        for host, stats in adaptive_limit_stats().items():
+            print(f'{host}: ended with {stats["limit"]:.1f} requests in '
+                  f'flight allowed', file=logfile)
+
     def __init__(self, cache_path: str, name: str,
                  list_scraper: type, details_scraper: type,
-                 processes=None):
+                 processes=None, concurrency: Optional[int] = None,
+                 fetch_threads: Optional[int] = None,
+                 hosts: Iterable[str] = (),
+                 rate_limit: Optional[RateLimit] = None,
+                 incremental: bool = False, max_age: Optional[float] = None,
+                 http_cache: Optional[str] = None, replay: bool = False,
+                 metrics_dir: Optional[str] = None,
+                 profile_dir: Optional[str] = None, adaptive: bool = False):
 
         self._cache_path = os.path.join(cache_path, name)
         if not os.path.exists(self._cache_path):
             os.mkdir(self._cache_path)
+        self._snapshot_path = os.path.join(self._cache_path, 'snapshot')
+        self._incremental = incremental
+        # Age in days after which details are fetched again when incremental
+        self._max_age = max_age
+
+        hosts = list(hosts)
+        if rate_limit is not None:
+            # Configured before any pool starts, so all workers share them
+            configure_rate_limits(
+                {host: rate_limit for host in hosts},
+                os.path.join(self._cache_path, 'ratelimit'))
+        if http_cache is not None:
+            # Raw responses, kept apart from the parsed caches so that
+            # a fresh cache_path re-parses them, offline with replay
+            configure_response_cache(http_cache, replay=replay)
+        elif replay:
+            raise ValueError('replay needs an http cache')
+        if metrics_dir is not None:
+            # Also before the pools, whose workers flush their own metrics
+            metrics.configure_metrics(metrics_dir, state=name)
+        if profile_dir is not None:
+            profiling.configure_profiling(profile_dir)
 
         if processes is None:
             # We allow user to omit the argument and choose processes
@@ -130,17 +926,99 @@ class AttorneysScraper(abc.ABC):
         elif isinstance(processes, str) and processes == 'none':
             # If user sets processes to none, we disable multiprocessing
             processes = None
+        elif isinstance(processes, str) and _thread_count(processes) is None:
+            # 'threads:N' is kept as is to run the workers on N threads
+            processes = int(processes)
+        if adaptive:
+            if len(hosts) == 0:
+                raise ValueError('adaptive concurrency needs the hosts')
+            # The workers become a ceiling, the requests in flight follow
+            # how the hosts respond
+            capacity = (concurrency or fetch_threads or
+                        _thread_count(processes) or processes)
+            configure_adaptive_limits(
+                hosts, os.path.join(self._cache_path, 'concurrency'),
+                max_limit=capacity or 1)
 
         self._list_scraper: ListScraper = (
-            list_scraper(cache_path=self._cache_path, processes=processes)
+            list_scraper(cache_path=self._cache_path, processes=processes,
+                         refresh=incremental)
         )
         self._details_scraper: DetailsScraper = (
-            details_scraper(cache_path=self._cache_path, processes=processes)
+            details_scraper(cache_path=self._cache_path, processes=processes,
+                            concurrency=concurrency,
+                            fetch_threads=fetch_threads)
         )
 
 
+def add_scraper_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds the command line options shared by the state scrapers: those of
+    AttorneysScraper under the names of its arguments, and those of
+    `write_scraped`
+    """
+    parser.add_argument('--processes', default=None,
+                        help="number of worker processes, 'none', or "
+                             "'threads:N' to use a pool of N threads")
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='fetch details with asyncio, keeping this '
+                             'many requests in flight')
+    parser.add_argument('--fetch-threads', type=int, default=None,
+                        help='fetch details on this many threads, leaving '
+                             'the worker processes to parse them')
+    parser.add_argument('--stream', action='store_true',
+                        help='fetch details while listing and write the '
+                             'output as rows complete')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only fetch details of new or changed attorneys '
+                             'and merge them into the previous snapshot')
+    parser.add_argument('--max-age', type=float, default=None,
+                        help='with --incremental, also re-fetch details '
+                             'older than this many days')
+    parser.add_argument('--http-cache', default=None,
+                        help='keep the raw responses in this directory and '
+                             'revalidate them instead of downloading again')
+    parser.add_argument('--replay', action='store_true',
+                        help='only read responses from --http-cache, to '
+                             're-parse them offline into a fresh cache')
+    parser.add_argument('--metrics', dest='metrics_dir', metavar='DIR',
+                        default=None,
+                        help='record request, cache and stage metrics in '
+                             'this directory and write report.json there')
+    parser.add_argument('--prometheus', default=None,
+                        help='with --metrics, also write the metrics to '
+                             'this file in the Prometheus text format')
+    parser.add_argument('--profile', dest='profile_dir', metavar='DIR',
+                        default=None,
+                        help='sample the stacks of every process and write '
+                             'per-stage flame graph input to this directory')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='adapt the requests in flight to the latency '
+                             'and errors of the host, up to the workers')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, default=None,
+                        metavar='RATE[:BURST]',
+                        help='requests per second to the host, shared by '
+                             'all the workers, unlimited by default')
+
+
+def write_scraped(scraper: AttorneysScraper, output, stream: bool = False,
+                  prometheus=None):
+    """
+    Scrapes into output, chunk by chunk if stream, then writes the
+    metrics report and the profiles of the run
+    """
+    if stream:
+        scraper.write_stream(output)
+    else:
+        attorneys = scraper.scrape()
+        with run_stage('write'):
+            write_frame(attorneys, output)
+    metrics.write_report(prometheus_path=prometheus)
+    profiling.write_profiles()
+
+
 class ListByLettersScraper(ListScraper):
-    _processes: int
+    _processes: Processes
 
     @abc.abstractmethod
     def _list_by_letter_internal(self, letter) -> pd.DataFrame:
@@ -157,7 +1035,7 @@ class ListByLettersScraper(ListScraper):
 
     def list_attorneys(self):
         if self._processes is not None:
-            with mp.Pool(processes=self._processes) as pool:
+            with open_pool(self._processes) as pool:
                 func = functools.partial(self._list_by_letter)
                 mapped = pool.map(func, letters)
         else:
@@ -168,6 +1046,149 @@ class ListByLettersScraper(ListScraper):
         frame = pd.concat(mapped).drop_duplicates(subset=['href'])
         return frame
 
+    def iter_frames(self) -> Iterator[pd.DataFrame]:
+        """Yields the frame of each letter as soon as it is listed"""
+        if self._processes is not None:
+            with open_pool(self._processes) as pool:
+                yield from pool.imap_unordered(self._list_by_letter, letters)
+        else:
+            for letter in letters:
+                yield self._list_by_letter(letter)
+
+    def work_units(self) -> List[str]:
+        return letters
+
+    def list_unit(self, unit) -> pd.DataFrame:
+        return self._list_by_letter(unit)
+
     def __init__(self, processes=None, **kwargs):
         super(ListByLettersScraper, self).__init__(**kwargs)
         self._processes = processes
+
+
+class ListByPagesScraper(ListByLettersScraper):
+    """
+    Lists every letter page by page. The pages of all letters are read
+    first, then every (letter, page) unit is scheduled on one pool and
+    cached on its own, so a letter with many pages is spread over all
+    workers instead of keeping one of them busy.
+    """
+
+    @abc.abstractmethod
+    def _letter_pages(self, letter) -> List[int]:
+        """Returns the page numbers to list for the letter"""
+
+    @abc.abstractmethod
+    def _list_page_internal(self, letter, page) -> pd.DataFrame:
+        pass
+
+    def _list_page(self, unit: Tuple[str, int]) -> pd.DataFrame:
+        letter, page = unit
+        cached_frame = self._cache_load_term_frame(f'{letter}-{page}')
+        if cached_frame is not None:
+            return cached_frame
+        frame = self._list_page_internal(letter, page)
+        self._cache_dump_term_frame(f'{letter}-{page}', frame)
+        return frame
+
+    def _letter_units(self, letter) -> List[Tuple[str, int]]:
+        return [(letter, page) for page in self._letter_pages(letter)]
+
+    def _list_by_letter_internal(self, letter) -> pd.DataFrame:
+        return pd.concat([self._list_page(unit)
+                          for unit in self._letter_units(letter)])
+
+    def list_attorneys(self):
+        frames = list(self.iter_frames(ordered=True))
+        return pd.concat(frames).drop_duplicates(subset=['href'])
+
+    def iter_frames(self, ordered: bool = False) -> Iterator[pd.DataFrame]:
+        """Yields the frame of every page as soon as it is listed"""
+        if self._processes is None:
+            for letter in letters:
+                for unit in self._letter_units(letter):
+                    yield self._list_page(unit)
+            return
+
+        with open_pool(self._processes) as pool:
+            units = [unit for letter_units in pool.map(self._letter_units, letters)
+                     for unit in letter_units]
+            imap = pool.imap if ordered else pool.imap_unordered
+            yield from tqdm(imap(self._list_page, units), total=len(units))
+
+
+class ListByPrefixesScraper(ListScraper):
+    """
+    Lists attorneys by searching name prefixes, starting with the letters.
+    A prefix whose results overflow is split into longer prefixes, which
+    are searched concurrently with every other pending prefix on one pool.
+    The rows of each resolved prefix are cached on their own and yielded
+    deduplicated by href as they arrive. The prefixes that overflowed are
+    kept in a prefix index, so later runs search the narrower ones directly.
+    """
+    _processes: Processes
+    # Seconds after which a prefix known to overflow is searched again
+    prefix_max_age: Optional[float] = 30 * 24 * 3600
+
+    @abc.abstractmethod
+    def _search_prefix_internal(self, prefix) -> Tuple[List[dict], bool]:
+        """Returns the rows of prefix and whether its results overflowed"""
+
+    def _expand_prefix(self, prefix) -> List[str]:
+        return [prefix + letter for letter in letters]
+
+    def _search_prefix(self, prefix) -> Tuple[List[dict], bool]:
+        cached_frame = self._cache_load_term_frame(f'prefix-{prefix}')
+        if cached_frame is not None:
+            return cached_frame.to_dict('records'), False
+        rows, overflow = self._search_prefix_internal(prefix)
+        if not overflow:
+            self._cache_dump_term_frame(f'prefix-{prefix}', pd.DataFrame(rows))
+        return rows, overflow
+
+    def list_attorneys(self):
+        frames = list(self.iter_frames())
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['href'])
+        return pd.concat(frames, ignore_index=True)
+
+    def _iter_prefix_frames(self, pool, roots: List[str] = letters
+                            ) -> Iterator[pd.DataFrame]:
+        hrefs = KeyIndex()
+        index_path = os.path.join(self._cache_path, 'prefixes.sqlite')
+        with PrefixIndex(index_path, max_age=self.prefix_max_age) as index:
+            resolved = search_prefixes(self._search_prefix, self._expand_prefix,
+                                       roots, pool=pool, index=index)
+            for _, rows in tqdm(resolved):
+                new_rows = []
+                for row in rows:
+                    if hrefs.add(row.get('href')):
+                        new_rows.append(row)
+                if len(new_rows) > 0:
+                    yield pd.DataFrame(new_rows)
+
+    def iter_frames(self) -> Iterator[pd.DataFrame]:
+        """Yields the new rows of every prefix as soon as it resolves"""
+        if self._processes is None:
+            yield from self._iter_prefix_frames(None)
+            return
+        with open_pool(self._processes) as pool:
+            yield from self._iter_prefix_frames(pool)
+
+    def work_units(self) -> List[str]:
+        return letters
+
+    def list_unit(self, unit) -> pd.DataFrame:
+        """Lists the prefixes starting with the letter unit"""
+        if self._processes is None:
+            frames = list(self._iter_prefix_frames(None, [unit]))
+        else:
+            with open_pool(self._processes) as pool:
+                frames = list(self._iter_prefix_frames(pool, [unit]))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['href'])
+        return pd.concat(frames, ignore_index=True)
+
+    def __init__(self, processes=None, **kwargs):
+        super(ListByPrefixesScraper, self).__init__(**kwargs)
+        self._processes = processes
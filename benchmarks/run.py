@@ -0,0 +1,235 @@
+"""
+Runs `AttorneysScraper.scrape()` and `write_stream` end to end for the
+state scrapers against the local replay server and reports pages/sec,
+server latency, peak RSS and CPU time per stage. Needs no network, so it can gate CI builds with
+`--baseline`, which fails the run when a stage regresses past `--tolerance`.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from scrapers.attorneys import california, oregon, washington
+from scrapers.attorneys.base import AttorneysScraper, process_rss_mb
+from scrapers.attorneys.frames import write_frame
+from scrapers.attorneys.benchmarks.server import serve
+from scrapers.attorneys.retry import RetryPolicy, set_retry_policy
+
+states = ['washington', 'oregon', 'california']
+
+
+def _point_to(state, server_url):
+    """Redirects the state module urls to the replay server"""
+    if state == 'washington':
+        washington.search_tpl = washington.search_tpl.replace(
+            'https://www.mywsba.org', server_url)
+        washington.member_url = washington.member_url.replace(
+            'https://www.mywsba.org', server_url)
+        return (washington.WashingtonAttorneysScraper,
+                washington.WashingtonListByLetters,
+                washington.WashingtonAttorneyDetails)
+    if state == 'oregon':
+        oregon.search_url = oregon.search_url.replace(
+            'https://www.osbar.org', server_url)
+        oregon.member_url = oregon.member_url.replace(
+            'https://www.osbar.org', server_url)
+        return (AttorneysScraper, oregon.OregonListByLetters,
+                oregon.OregonAttorneyDetails)
+    if state == 'california':
+        california.search_tpl = california.search_tpl.replace(
+            california.base_url, server_url)
+        california.base_url = server_url
+        return (AttorneysScraper, california.CaliforniaListByLetterScraper,
+                california.CaliforniaDetailsScraper)
+    raise ValueError(f'unknown state {state}')
+
+
+def _cpu_time() -> float:
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (self_usage.ru_utime + self_usage.ru_stime
+            + children.ru_utime + children.ru_stime)
+
+
+def _peak_rss_mb() -> float:
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(self_rss, children_rss) / 1024
+
+
+def _server_stats(server_url, reset=False) -> dict:
+    path = '/__reset' if reset else '/__stats'
+    with urllib.request.urlopen(server_url + path, timeout=5) as resp:
+        return json.load(resp)
+
+
+class _Stage:
+    """
+    Measures one stage: wall and CPU time, the server side requests and
+    the peak RSS of this process and its workers, sampled on a thread
+    """
+
+    def _sample_rss(self):
+        while not self._stopped.wait(self.rss_interval):
+            self._sample_once()
+
+    def _sample_once(self):
+        # The replay server is a child process too, but not the scraper's
+        rss = process_rss_mb(os.getpid()) - process_rss_mb(self._server_pid)
+        self._peak_rss = max(self._peak_rss, rss)
+
+    def __enter__(self):
+        _server_stats(self._server_url, reset=True)
+        self._sample_once()
+        self._sampler.start()
+        self._started, self._cpu = time.perf_counter(), _cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self._started
+        self._stopped.set()
+        self._sampler.join()
+        stats = _server_stats(self._server_url)
+        self.report.update({
+            'wall': wall, 'cpu': _cpu_time() - self._cpu,
+            'pages': stats['requests'],
+            'pages_per_sec': stats['requests'] / wall if wall > 0 else 0.0,
+            'errors': stats['errors'],
+            'latency_p50': stats['p50'], 'latency_p99': stats['p99'],
+            'peak_rss_mb': self._peak_rss})
+
+    def __init__(self, server_url, server_pid, rss_interval: float = 0.05):
+        self._server_url = server_url
+        self._server_pid = server_pid
+        self.rss_interval = rss_interval
+        self._peak_rss = 0.0
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+        self.report = {}
+
+
+def bench_state(state, server_url, server_pid, processes, concurrency,
+                fetch_threads=None) -> dict:
+    """
+    Benchmarks scrape() then the write of its frame, and write_stream on
+    a fresh cache, so that both fetch every page
+    """
+    scraper_cls, list_cls, details_cls = _point_to(state, server_url)
+
+    def make_scraper(cache):
+        return scraper_cls(cache_path=cache, name=state,
+                           list_scraper=list_cls, details_scraper=details_cls,
+                           processes=processes, concurrency=concurrency,
+                           fetch_threads=fetch_threads)
+
+    stages = {}
+    with tempfile.TemporaryDirectory() as cache:
+        scraper = make_scraper(cache)
+        with _Stage(server_url, server_pid) as stage:
+            attorneys = scraper.scrape()
+        stages['scrape'] = stage.report
+        with _Stage(server_url, server_pid) as stage:
+            write_frame(attorneys, os.path.join(cache, 'output.csv'))
+        stages['write'] = stage.report
+    with tempfile.TemporaryDirectory() as cache:
+        scraper = make_scraper(cache)
+        with _Stage(server_url, server_pid) as stage:
+            scraper.write_stream(os.path.join(cache, 'output.csv'))
+        stages['stream'] = stage.report
+    return {'rows': len(attorneys), 'stages': stages,
+            'peak_rss_mb': _peak_rss_mb()}
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Returns the regressions of report against the baseline report"""
+    regressions = []
+    for state, state_report in report['states'].items():
+        base_state = baseline['states'].get(state)
+        if base_state is None:
+            continue
+        for name, stage in state_report['stages'].items():
+            base_stage = base_state['stages'].get(name)
+            if base_stage is None:
+                continue
+            if (base_stage['pages'] > 0 and stage['pages_per_sec']
+                    < base_stage['pages_per_sec'] * (1 - tolerance)):
+                regressions.append(
+                    f'{state}/{name}: {stage["pages_per_sec"]:.1f} pages/sec, '
+                    f'baseline {base_stage["pages_per_sec"]:.1f}')
+            # Stages shorter than a second are too noisy to compare
+            if (base_stage['cpu'] > 1.0
+                    and stage['cpu'] > base_stage['cpu'] * (1 + tolerance)):
+                regressions.append(
+                    f'{state}/{name}: {stage["cpu"]:.2f}s cpu, '
+                    f'baseline {base_stage["cpu"]:.2f}s')
+            base_rss = base_stage.get('peak_rss_mb')
+            if (base_rss is not None
+                    and stage['peak_rss_mb'] > base_rss * (1 + tolerance)):
+                regressions.append(
+                    f'{state}/{name}: {stage["peak_rss_mb"]:.0f}MB peak rss, '
+                    f'baseline {base_rss:.0f}MB')
+    return regressions
+
+
+def main(args):
+    port = args.port
+    ready = mp.Event()
+    server = mp.Process(target=serve, daemon=True,
+                        args=(port, args.roster_size),
+                        kwargs={'latency': args.latency, 'jitter': args.jitter,
+                                'error_rate': args.error_rate, 'ready': ready})
+    server.start()
+    ready.wait(timeout=30)
+    server_url = f'http://127.0.0.1:{port}'
+
+    # Errors are injected on purpose, retry them quickly
+    set_retry_policy(RetryPolicy(base_delay=0.05, max_delay=1.0))
+    report = {'config': vars(args), 'states': {}}
+    try:
+        for state in args.states:
+            print(f'benchmarking {state}...', file=sys.stderr)
+            report['states'][state] = bench_state(
+                state, server_url, server.pid, args.processes,
+                args.concurrency, args.fetch_threads)
+    finally:
+        server.terminate()
+        server.join()
+
+    print(json.dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--states', nargs='+', default=states, choices=states)
+    parser.add_argument('--roster-size', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--jitter', type=float, default=0.002)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--processes', default='threads:16')
+    parser.add_argument('--concurrency', type=int, default=None)
+    parser.add_argument('--fetch-threads', type=int, default=None)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--output', default=None,
+                        help='write the JSON report to this file')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    main(parser.parse_args())
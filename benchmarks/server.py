@@ -0,0 +1,249 @@
+"""
+Local stand-in for the bar sites, serving synthetic pages in the markup
+the state parsers expect, with configurable latency, error rate and
+roster size. Start it with `serve` or `python -m ...benchmarks.server`.
+"""
+import argparse
+import hashlib
+import http.server
+import json
+import multiprocessing as mp
+import random
+import string
+import threading
+import time
+import urllib.parse
+from html import escape
+
+letters = list(string.ascii_lowercase)
+
+wa_page_size = 20
+or_page_size = 20
+ca_result_cap = 500
+overflow_text = 'Only the first 500 results will be shown.'
+
+
+class Roster:
+    """Deterministic synthetic attorneys, covering every initial"""
+
+    def __init__(self, size: int, seed: int = 0):
+        rng = random.Random(seed)
+        self.attorneys = []
+        for i in range(size):
+            first = letters[i % 26] + ''.join(rng.choices(letters, k=5))
+            last = letters[(i * 7) % 26] + ''.join(rng.choices(letters, k=6))
+            self.attorneys.append({
+                'bar_num': str(10000 + i), 'first': first.title(),
+                'last': last.title(), 'city': rng.choice(['Seattle', 'Portland', 'Fresno']),
+                'status': 'Active', 'phone': f'555-{i:04d}',
+                'email': f'{first}.{last}@example.com'})
+        self.by_bar_num = {a['bar_num']: a for a in self.attorneys}
+        self.by_surname = sorted(self.attorneys,
+                                 key=lambda a: (a['last'].lower(), a['bar_num']))
+
+
+def _wa_list(roster: Roster, query) -> str:
+    letter = query.get('FirstName', [''])[0].lower()
+    page = int(query.get('Page', ['0'])[0])
+    matched = [a for a in roster.attorneys if a['first'].lower().startswith(letter)]
+    rows = matched[page * wa_page_size:(page + 1) * wa_page_size]
+    trs = ''.join(
+        f'<tr class="grid-row"><td>{a["bar_num"]}</td><td>{a["first"]}</td>'
+        f'<td>{a["last"]}</td><td>{a["city"]}</td><td>{a["status"]}</td>'
+        f'<td>{a["phone"]}</td></tr>' for a in rows)
+    return (
+        '<html><body><span id="dnn_ctr2972_DNNWebControlContainer_ctl00_lblRowCount">'
+        f'{len(matched)} results</span>'
+        '<table id="dnn_ctr2972_DNNWebControlContainer_ctl00_dg">'
+        f'<tr class="grid-header"><td>Bar</td></tr>{trs}</table></body></html>')
+
+
+def _wa_profile(roster: Roster, query) -> str:
+    attorney = roster.by_bar_num[query['Usr_ID'][0].lstrip('0')]
+    prefix = 'dnn_ctr2977_DNNWebControlContainer_ctl00_'
+    return (
+        f'<html><body><div id="{prefix}ContainerPanel">'
+        f'<span id="{prefix}lblStatus">{attorney["status"]}</span>'
+        f'<span id="{prefix}lblWaAdmitDate">1/1/2000</span>'
+        f'<span id="{prefix}lblPhone">{attorney["phone"]}</span>'
+        f'<span id="{prefix}lblEmail">{attorney["email"]}</span>'
+        '</div></body></html>')
+
+
+def _or_list(roster: Roster, query) -> str:
+    # The roster is listed as a whole, sorted by surname, for any letter
+    page = int(query.get('cp', ['1'])[0])
+    n_pages = (len(roster.by_surname) - 1) // or_page_size + 1
+    rows = roster.by_surname[(page - 1) * or_page_size:page * or_page_size]
+    trs = ''.join(
+        f'<tr><td>{a["bar_num"]}</td><td>{a["last"]}, {a["first"]}</td>'
+        f'<td>{a["city"]}</td></tr>' for a in rows)
+    return (
+        f'<html><body><div class="pagingheader"><h3>Page {page} of {n_pages}</h3>'
+        '</div><table id="tblResults"><thead><tr><th>Bar</th><th>Name</th>'
+        f'<th>City</th></tr></thead><tbody>{trs}</tbody></table></body></html>')
+
+
+def _or_profile(roster: Roster, query) -> str:
+    attorney = roster.by_bar_num[query['b'][0]]
+    return (
+        '<html><body><table id="tbl_member">'
+        f'<tr><td>Bar Number</td><td id="mnum">{attorney["bar_num"]}</td></tr>'
+        f'<tr><td>Status</td><td id="mstatus">{attorney["status"]}</td></tr>'
+        '<tr><td>Admitted</td><td id="madmitdate">1/1/2000</td></tr>'
+        f'<tr><td>Phone</td><td id="mphone">{attorney["phone"]}</td></tr>'
+        f'<tr><td>Email</td><td id="memail"><a href="mailto:{attorney["email"]}">'
+        f'{attorney["email"]}</a></td></tr>'
+        f'<tr><td>City</td><td>{attorney["city"]}</td></tr>'
+        '</table></body></html>')
+
+
+def _ca_search(roster: Roster, query) -> str:
+    term = query.get('FreeText', [''])[0].lower()
+    matched = [a for a in roster.by_surname
+               if f'{a["last"]} {a["first"]}'.lower().startswith(term)]
+    strong = overflow_text if len(matched) > ca_result_cap else f'{len(matched)} results'
+    trs = ''.join(
+        f'<tr><td><a href="/attorney/Licensee/Detail/{a["bar_num"]}">'
+        f'{a["last"]}, {a["first"]}</a></td><td>{a["status"]}</td>'
+        f'<td>{a["bar_num"]}</td><td>{a["city"]}</td><td>1/1/2000</td></tr>'
+        for a in matched[:ca_result_cap])
+    return (
+        f'<html><body><strong>{strong}</strong><table id="tblAttorney"><thead><tr>'
+        '<th>Name</th><th>Status</th><th>Number</th><th>City</th>'
+        f'<th>Admission Date</th></tr></thead><tbody>{trs}</tbody></table>'
+        '</body></html>')
+
+
+def _ca_detail(roster: Roster, bar_num) -> str:
+    attorney = roster.by_bar_num[bar_num]
+    # Decoy emails hidden with css, as on the real site
+    return (
+        '<html><head><style>#e0{display:none;}#e1{display:inline;}'
+        '#e2{display:none;}</style></head><body><div id="moduleMemberDetail">'
+        '<p>Address: 1 Main St, Fresno</p>'
+        f'<p>Phone: {attorney["phone"]} | Fax: 555-0000</p>'
+        '<span id="e0">decoy@example.com</span>'
+        f'<span id="e1">{escape(attorney["email"])}</span>'
+        '<span id="e2">decoy@example.org</span>'
+        '<a id="websiteLink" href="https://example.com">example.com</a>'
+        '</div></body></html>')
+
+
+def _route(roster: Roster, url) -> str:
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qs(parts.query)
+    path = parts.path
+    if path == '/personifyebusiness/LegalDirectory.aspx':
+        return _wa_list(roster, query)
+    if path == '/personifyebusiness/LegalDirectory/LegalProfile.aspx':
+        return _wa_profile(roster, query)
+    if path == '/members/membersearch.asp':
+        return _or_list(roster, query)
+    if path == '/members/membersearch_display.asp':
+        return _or_profile(roster, query)
+    if path == '/attorney/LicenseeSearch/QuickSearch':
+        return _ca_search(roster, query)
+    if path.startswith('/attorney/Licensee/Detail/'):
+        return _ca_detail(roster, path.rsplit('/', 1)[1])
+    raise KeyError(path)
+
+
+class ReplayServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def stats(self) -> dict:
+        with self.lock:
+            latencies = sorted(self.latencies)
+            errors, count = self.errors, len(self.latencies)
+        if count == 0:
+            return {'requests': 0, 'errors': errors, 'p50': None, 'p99': None}
+        return {'requests': count, 'errors': errors,
+                'p50': latencies[int(0.50 * (count - 1))],
+                'p99': latencies[int(0.99 * (count - 1))]}
+
+    def reset(self):
+        with self.lock:
+            self.latencies, self.errors = [], 0
+
+    def __init__(self, address, roster: Roster, latency: float = 0.0,
+                 jitter: float = 0.0, error_rate: float = 0.0):
+        super(ReplayServer, self).__init__(address, ReplayHandler)
+        self.roster = roster
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.latencies, self.errors = [], 0
+
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    server: ReplayServer
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, avoid delayed ack stalls
+    disable_nagle_algorithm = True
+
+    def _send(self, status, body: bytes, content_type='text/html', etag=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/__stats':
+            return self._send(200, json.dumps(self.server.stats()).encode(),
+                              content_type='application/json')
+        if self.path == '/__reset':
+            self.server.reset()
+            return self._send(200, b'{}', content_type='application/json')
+
+        started = time.perf_counter()
+        server = self.server
+        time.sleep(max(0.0, random.gauss(server.latency, server.jitter)))
+        if random.random() < server.error_rate:
+            self._send(503, b'', content_type='text/plain')
+            with server.lock:
+                server.errors += 1
+            return
+        try:
+            body = _route(server.roster, self.path).encode()
+        except KeyError:
+            return self._send(404, b'', content_type='text/plain')
+        # Lets clients revalidate their cached pages
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self._send(304, b'', etag=etag)
+        else:
+            self._send(200, body, etag=etag)
+        with server.lock:
+            server.latencies.append(time.perf_counter() - started)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, roster_size, latency=0.0, jitter=0.0, error_rate=0.0,
+          ready: mp.Event = None):
+    server = ReplayServer(('127.0.0.1', port), Roster(roster_size),
+                          latency=latency, jitter=jitter,
+                          error_rate=error_rate)
+    if ready is not None:
+        ready.set()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--roster-size', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='mean seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of requests answered with a 503')
+    args = parser.parse_args()
+    serve(args.port, args.roster_size, latency=args.latency,
+          jitter=args.jitter, error_rate=args.error_rate)
@@ -1,92 +1,92 @@
 import pandas as pd
 import argparse
-import random
-import time
 import re
 import string
 from typing import List, Tuple
 
+import lxml.etree
+
 from scrapers.attorneys.base import (
-    safe_get_soup, AttorneysScraper, ListByLettersScraper, DetailsScraper)
+    safe_get_content, AttorneysScraper, ListByPrefixesScraper,
+    DetailsScraper, add_scraper_arguments, write_scraped)
+from scrapers.attorneys.extract import node_text, parse_html
 
 base_url = 'https://apps.calbar.ca.gov'
 search_tpl = base_url + '/attorney/LicenseeSearch/QuickSearch?FreeText={term}'
 overflow_text = 'Only the first 500 results will be shown.'
+# Host of the bar site, rate limited only when given a rate_limit
+host = 'apps.calbar.ca.gov'
 letters = list(string.ascii_lowercase)
 
+table_xpath = lxml.etree.XPath('//table[@id="tblAttorney"]')
+header_xpath = lxml.etree.XPath('descendant::thead[1]//th')
+rows_xpath = lxml.etree.XPath('descendant::tbody[1]//tr')
+cells_xpath = lxml.etree.XPath('.//td')
+anchor_xpath = lxml.etree.XPath('descendant::a[1]')
+strong_xpath = lxml.etree.XPath('//strong')
+style_xpath = lxml.etree.XPath('//style')
+span_xpath = lxml.etree.XPath('//span[@id=$cid]')
+member_details_xpath = lxml.etree.XPath('//*[@id="moduleMemberDetail"]')
+paragraphs_xpath = lxml.etree.XPath('.//p')
+website_xpath = lxml.etree.XPath('.//a[@id="websiteLink"]')
+
 
 def parse_table(table):
     if table is None:
         return []
 
-    thead = table.find('thead')
-    header = [th.text.strip() for th in thead.findAll('th')]
+    header = [node_text(th).strip() for th in header_xpath(table)]
 
-    tbody = table.find('tbody')
     results = []
-    for row in tbody.findAll('tr'):
+    for row in rows_xpath(table):
         row_dict = {}
-        for i, cell in enumerate(row.findAll('td')):
-            if (a := cell.find('a')) is not None:
-                row_dict['href'] = a.attrs['href']
-            row_dict[header[i]] = cell.text.strip()
+        for i, cell in enumerate(cells_xpath(row)):
+            if len(a := anchor_xpath(cell)) > 0:
+                row_dict['href'] = a[0].get('href')
+            row_dict[header[i]] = node_text(cell).strip()
         results.append(row_dict)
     return results
 
 
-def search_term(term, template, verbose=True, logfile=None, ignore_overflow=False):
-    if verbose:
-        print(f'searching term "{term}"...', file=logfile)
-
-    soup = safe_get_soup(template.format(term=term))
-    table = soup.find('table', id='tblAttorney')
-    strong_texts = [strong.text for strong in soup.findAll('strong')]
-    if overflow_text in strong_texts and not ignore_overflow:
-        results = []
-        for letter in letters:
-            result = search_term(term + letter, template, verbose=verbose)
-            results.extend(result)
-        if ' ' not in term:
-            for letter in letters:
-                result = search_term(
-                    term + ' ' + letter, template, verbose=verbose)
-                results.extend(result)
-    else:
-        # derive results from table
-        results = parse_table(table)
+def search_page(term, template) -> Tuple[List[dict], bool]:
+    """Returns the rows listed for term and whether they overflowed"""
+    root = parse_html(safe_get_content(template.format(term=term)))
+    tables = table_xpath(root)
+    table = tables[0] if len(tables) > 0 else None
+    strong_texts = [node_text(strong) for strong in strong_xpath(root)]
+    return parse_table(table), overflow_text in strong_texts
 
-    if verbose:
-        print(f'found {len(results)} results for "{term}"', file=logfile)
 
-    if random.random() > 0.9:
-        if verbose:
-            print('random timeout!', file=logfile)
-        time.sleep(1)
-    return results
+def expand_term(term) -> List[str]:
+    """Returns the narrower terms to search when term overflows"""
+    terms = [term + letter for letter in letters]
+    if ' ' not in term:
+        terms.extend(term + ' ' + letter for letter in letters)
+    return terms
 
 
 def find_correct_email(attorney_page):
-    hidden = [style for style in attorney_page.findAll('style')
-              if style.text.strip().startswith('#e0')]
+    hidden = [style for style in style_xpath(attorney_page)
+              if node_text(style).strip().startswith('#e0')]
     if len(hidden) == 0:
         return None
-    correct = [item for item in hidden[0].text.strip().split('#')
+    correct = [item for item in node_text(hidden[0]).strip().split('#')
                if 'inline' in item]
     matched = re.match(r'(?P<cid>e\d+)\{.*', correct[0])
     if matched is not None:
         cid = matched.groupdict()['cid']
-        email = attorney_page.find('span', id=cid)
-        if email is not None:
-            return email.text
+        email = span_xpath(attorney_page, cid=cid)
+        if len(email) > 0:
+            return node_text(email[0])
         return None
     else:
         return None
 
 
-def attorney_details(page_url):
-    attorney_page = safe_get_soup(base_url + page_url)
-    member_details = attorney_page.find(id='moduleMemberDetail')
-    ps = [p.text.strip() for p in member_details.findAll('p')]
+def parse_attorney_details(page_url, content):
+    attorney_page = parse_html(content)
+    member_details = member_details_xpath(attorney_page)[0]
+    ps = [node_text(p).strip() for p in paragraphs_xpath(member_details)]
 
     details = {}
     for p in ps:
@@ -100,16 +100,25 @@ def attorney_details(page_url):
     if email is not None:
         details['email'] = email
 
-    website_anchor = member_details.find('a', id='websiteLink')
-    if website_anchor is not None:
-        details['website'] = website_anchor.text.strip()
+    website_anchor = website_xpath(member_details)
+    if len(website_anchor) > 0:
+        details['website'] = node_text(website_anchor[0]).strip()
     return page_url, details
 
 
-class CaliforniaListByLetterScraper(ListByLettersScraper):
-    def _list_by_letter_internal(self, letter) -> pd.DataFrame:
-        letter_terms = search_term(letter, template=search_tpl, verbose=True, ignore_overflow=True)
-        return pd.DataFrame(letter_terms)
+def attorney_details(page_url):
+    content = safe_get_content(base_url + page_url)
+    return parse_attorney_details(page_url, content)
+
+
+class CaliforniaListByLetterScraper(ListByPrefixesScraper):
+    watch_columns = ['Status', 'City']
+
+    def _search_prefix_internal(self, prefix) -> Tuple[List[dict], bool]:
+        return search_page(prefix, search_tpl)
+
+    def _expand_prefix(self, prefix) -> List[str]:
+        return expand_term(prefix)
 
 
 class CaliforniaDetailsScraper(DetailsScraper):
@@ -122,18 +131,32 @@ class CaliforniaDetailsScraper(DetailsScraper):
     def _page_details(self, page_url) -> Tuple[str, dict]:
         return attorney_details(page_url)
 
+    def _page_fetch_url(self, page_url) -> str:
+        return base_url + page_url
+
+    def _parse_page_details(self, page_url, content) -> Tuple[str, dict]:
+        return parse_attorney_details(page_url, content)
+
+
+def make_scraper(cache_path, **kwargs) -> AttorneysScraper:
+    """The California scraper, kwargs are those of AttorneysScraper"""
+    return AttorneysScraper(cache_path=cache_path, name='california',
+                            list_scraper=CaliforniaListByLetterScraper,
+                            details_scraper=CaliforniaDetailsScraper,
+                            hosts=[host], **kwargs)
+
 
-def main(output):
-    scraper = AttorneysScraper(cache_path='/tmp/cache',
-                               name='california',
-                               list_scraper=CaliforniaListByLetterScraper,
-                               details_scraper=CaliforniaDetailsScraper)
-    frame = scraper.scrape()
-    frame.to_csv(output)
+def main(output, stream=False, prometheus=None, **kwargs):
+    """Scrapes into output, kwargs are those of AttorneysScraper"""
+    scraper = make_scraper('/tmp/cache', **kwargs)
+    write_scraped(scraper, output, stream=stream, prometheus=prometheus)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('output')
+    parser.add_argument('output',
+                        help='csv file, parquet if it ends with .parquet, '
+                             'or json lines if it ends with .jsonl')
+    add_scraper_arguments(parser)
     args = parser.parse_args()
-    main(args.output)
+    main(**vars(args))
@@ -0,0 +1,287 @@
+import asyncio
+import fcntl
+import json
+import os
+import threading
+import time
+import urllib.parse
+import weakref
+from typing import Dict, Iterable, Optional
+
+from scrapers.attorneys import metrics
+
+# Statuses meaning the host is overloaded or failing
+overload_statuses = frozenset({429, 500, 502, 503, 504})
+
+
+class AdaptiveLimit:
+    """
+    AIMD limit on the requests in flight to one host. Once the first
+    `warmup` responses have set the host's baseline latency, every
+    request that comes back healthy raises the limit, by one during the
+    initial slow start and by one per window of `limit` requests after
+    that. A 429,
+    a 5xx, a failed request or a latency above latency_tolerance times
+    the host's baseline latency cuts it by a factor, once per window:
+    requests sent before the last cut do not cut it again, as in TCP
+    congestion control. Like the rate limiter, its state lives in a small
+    file guarded by flock, shared by all the workers of a run, which
+    record their requests in flight under their pid.
+    """
+
+    def _update(self, change):
+        """
+        Applies change to the state under the lock. change returns its
+        result and whether it modified the state, which is only written
+        back then.
+        """
+        with open(self._path, 'r+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state = json.load(state_file)
+            result, changed = change(state)
+            if changed:
+                state_file.seek(0)
+                state_file.truncate()
+                json.dump(state, state_file)
+        return result
+
+    def try_acquire(self) -> bool:
+        """Takes a slot if fewer requests than the limit are in flight"""
+        pid = str(os.getpid())
+
+        def take(state):
+            in_flight = state['in_flight']
+            dead = [other for other in in_flight
+                    if other != pid and not _alive(int(other))]
+            for other in dead:
+                # Slots of a worker that died with requests in flight
+                del in_flight[other]
+            if sum(in_flight.values()) >= int(state['limit']):
+                return False, len(dead) > 0
+            in_flight[pid] = in_flight.get(pid, 0) + 1
+            return True, True
+
+        return self._update(take)
+
+    def acquire(self):
+        if self.try_acquire():
+            return
+        # One waiting thread per process polls the file, woken early by
+        # the releases of this process
+        with self._turn:
+            delay = self.poll_interval
+            while not self.try_acquire():
+                if self._released.wait(delay):
+                    self._released.clear()
+                    delay = self.poll_interval
+                else:
+                    delay = min(2 * delay, self.max_poll_interval)
+
+    async def acquire_async(self):
+        if self.try_acquire():
+            return
+        # Likewise one waiting task per event loop polls the file
+        loop = asyncio.get_running_loop()
+        turn, released = self._async_turns.setdefault(
+            loop, (asyncio.Lock(), asyncio.Event()))
+        async with turn:
+            delay = self.poll_interval
+            while not self.try_acquire():
+                try:
+                    await asyncio.wait_for(released.wait(), delay)
+                    released.clear()
+                    delay = self.poll_interval
+                except asyncio.TimeoutError:
+                    delay = min(2 * delay, self.max_poll_interval)
+
+    def release(self, sent_at: float, status=None):
+        """
+        Gives the slot back, adapting the limit to the outcome of the
+        request sent at time sent_at: its status, or None if it raised
+        """
+        pid = str(os.getpid())
+        latency = time.time() - sent_at
+
+        def give_back(state):
+            in_flight = state['in_flight']
+            in_flight[pid] = max(0, in_flight.get(pid, 0) - 1)
+            if status is None or status in overload_statuses:
+                reason = 'error' if status is None else str(status)
+                self._decrease(state, sent_at, self.backoff, reason)
+            elif status >= 400:
+                # Client errors tell nothing of the host's load
+                pass
+            elif self._is_slow(state, latency):
+                # Leaving slow start overshot, cut as much as for errors
+                factor = (self.backoff if state['slow_start']
+                          else self.latency_backoff)
+                self._decrease(state, sent_at, factor, 'latency')
+            else:
+                self._increase(state)
+            # A 304 revalidates a cached page without sending it, and
+            # would drag the baseline below the host's real responses
+            if status is not None and status < 400 and status != 304:
+                self._track_baseline(state, latency)
+            return state['limit'], True
+
+        limit = self._update(give_back)
+        self._released.set()
+        for loop, (_, released) in list(self._async_turns.items()):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(released.set)
+        metrics.gauge('concurrency_limit', limit, host=self.host)
+
+    def _increase(self, state):
+        if state['samples'] < self.warmup:
+            # The baseline is measured at the initial limit, unloaded
+            return
+        step = 1.0 if state['slow_start'] else 1.0 / state['limit']
+        state['limit'] = min(float(self.max_limit), state['limit'] + step)
+
+    def _decrease(self, state, sent_at: float, factor: float, reason):
+        if sent_at < state['decreased_at']:
+            return
+        state['limit'] = max(float(self.min_limit), state['limit'] * factor)
+        state['decreased_at'] = time.time()
+        state['slow_start'] = False
+        metrics.inc('concurrency_decreases_total', host=self.host,
+                    reason=reason)
+
+    def _is_slow(self, state, latency: float) -> bool:
+        return (state['baseline'] is not None and
+                latency > self.latency_tolerance * state['baseline'])
+
+    def _track_baseline(self, state, latency: float):
+        # Average of the healthy latencies, plain for the first samples
+        # then exponentially weighted. Slow responses are left out once
+        # warmed up, as they are the load's doing, unless the limit is
+        # already at its lowest and they are the host's own.
+        samples = state['samples']
+        if (samples >= self.warmup and self._is_slow(state, latency) and
+                state['limit'] > self.min_limit):
+            return
+        weight = max(1.0 / (samples + 1), self.smoothing)
+        baseline = state['baseline']
+        state['baseline'] = (latency if baseline is None
+                             else baseline + weight * (latency - baseline))
+        state['samples'] = samples + 1
+
+    def stats(self) -> dict:
+        with open(self._path) as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_SH)
+            state = json.load(state_file)
+        return {'limit': state['limit'], 'baseline': state['baseline']}
+
+    def reset(self):
+        with open(self._path, 'w') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            json.dump({'limit': float(self.initial_limit), 'in_flight': {},
+                       'baseline': None, 'samples': 0, 'decreased_at': 0.0,
+                       'slow_start': True}, state_file)
+
+    def __init__(self, path, host, max_limit: int, min_limit: int = 1,
+                 initial_limit: Optional[int] = None, backoff: float = 0.5,
+                 latency_backoff: float = 0.9, latency_tolerance: float = 3.0,
+                 warmup: int = 20, smoothing: float = 0.05):
+        self._path = path
+        self.host = host
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.initial_limit = max(min_limit, min(initial_limit or 2, max_limit))
+        # Factor applied to the limit on an error, and on a slow response
+        self.backoff = backoff
+        self.latency_backoff = latency_backoff
+        self.latency_tolerance = latency_tolerance
+        # Samples averaged plainly, and weight of a sample after them
+        self.warmup = warmup
+        self.smoothing = smoothing
+        # Seconds between polls of the file while waiting for a slot
+        self.poll_interval = 0.005
+        self.max_poll_interval = 0.1
+        self._turn = threading.Lock()
+        self._released = threading.Event()
+        self._async_turns = weakref.WeakKeyDictionary()
+        if not os.path.exists(path):
+            self.reset()
+
+    def _after_fork(self):
+        self._turn = threading.Lock()
+        self._released = threading.Event()
+        self._async_turns = weakref.WeakKeyDictionary()
+
+
+def _alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Slot:
+    """A request in flight under an adaptive limit, see `acquire_slot`"""
+
+    def done(self, status=None):
+        """Releases the slot with the status of the response, or None if
+        the request raised. Only the first call counts."""
+        if self._limit is None:
+            return
+        limit, self._limit = self._limit, None
+        limit.release(self._sent_at, status)
+
+    def __init__(self, limit: Optional[AdaptiveLimit]):
+        self._limit = limit
+        self._sent_at = time.time()
+
+
+_limits: Dict[str, AdaptiveLimit] = {}
+
+
+def _after_fork():
+    # Locks held by other threads of the parent are never released
+    for limit in _limits.values():
+        limit._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def configure_adaptive_limits(hosts: Iterable[str], state_dir,
+                              max_limit: int, **kwargs):
+    """
+    Puts the requests to hosts under adaptive limits of at most
+    max_limit requests in flight, kwargs go to AdaptiveLimit.
+    Must be called before the worker pools are started.
+    """
+    if not os.path.exists(state_dir):
+        os.mkdir(state_dir)
+    for host in hosts:
+        limit = AdaptiveLimit(os.path.join(state_dir, f'{host}.json'), host,
+                              max_limit=max_limit, **kwargs)
+        limit.reset()
+        _limits[host] = limit
+
+
+def get_adaptive_limit(url) -> Optional[AdaptiveLimit]:
+    return _limits.get(urllib.parse.urlsplit(url).netloc)
+
+
+def acquire_slot(url) -> Slot:
+    """Waits for room under the adaptive limit of the host of url, if any"""
+    limit = get_adaptive_limit(url)
+    if limit is not None:
+        limit.acquire()
+    return Slot(limit)
+
+
+async def acquire_slot_async(url) -> Slot:
+    limit = get_adaptive_limit(url)
+    if limit is not None:
+        await limit.acquire_async()
+    return Slot(limit)
+
+
+def adaptive_limit_stats() -> Dict[str, dict]:
+    return {host: limit.stats() for host, limit in _limits.items()}
@@ -0,0 +1,167 @@
+"""
+Runs a state scraper on several nodes sharing a `WorkQueue` file. Every
+node runs the same command: the listing units are leased first, then the
+detail pages of the merged listing, and nodes that pass --output write the
+combined frame once all units are done. Rerunning resumes the queue.
+"""
+import argparse
+import contextlib
+import functools
+import importlib
+import io
+import json
+from typing import List
+
+import pandas as pd
+
+from scrapers.attorneys.base import (
+    AttorneysScraper, _thread_count, open_executor, open_pool, use_pool)
+from scrapers.attorneys.frames import write_frame
+from scrapers.attorneys.ratelimit import parse_rate_limit
+from scrapers.attorneys.runner import Budget, SharedPool
+from scrapers.attorneys.retry import FetchFailure
+from scrapers.attorneys.store import DetailsStore
+from scrapers.attorneys.workqueue import WorkQueue
+
+states = ['washington', 'oregon', 'california']
+
+
+def _list_units(queue: WorkQueue, scraper: AttorneysScraper, name,
+                units: List[str]):
+    for unit in units:
+        try:
+            frame = scraper._list_scraper.list_unit(unit)
+        except Exception as ex:
+            queue.fail(name, unit, repr(ex))
+            continue
+        queue.complete(name, [(unit, frame.to_json(orient='records'))])
+
+
+def _fetch_units(queue: WorkQueue, scraper: AttorneysScraper, name,
+                 units: List[str]):
+    details_scraper = scraper._details_scraper
+    results, seen = [], set()
+    try:
+        for page, details in details_scraper._iter_results(units):
+            seen.add(page)
+            if isinstance(details, FetchFailure):
+                queue.fail(name, page, details.error)
+            else:
+                results.append((page, json.dumps(details)))
+    except Exception:
+        # A page failed to parse, the rest of the batch is fetched one
+        # page at a time to fail only the bad page
+        for page in units:
+            if page in seen:
+                continue
+            try:
+                page, details = details_scraper._safe_page_details(page)
+            except Exception as ex:
+                queue.fail(name, page, repr(ex))
+                continue
+            if isinstance(details, FetchFailure):
+                queue.fail(name, page, details.error)
+            else:
+                results.append((page, json.dumps(details)))
+    queue.complete(name, results)
+
+
+@contextlib.contextmanager
+def _details_pool(scraper: AttorneysScraper):
+    """Opens the pool of the details once for all the batches of a node"""
+    details_scraper = scraper._details_scraper
+    processes = details_scraper._processes
+    if processes is None:
+        yield
+        return
+    if details_scraper._concurrency is not None:
+        # The asyncio engine parses on an executor
+        with open_executor(processes) as executor, use_pool(None, executor):
+            yield
+        return
+    workers = _thread_count(processes) or processes
+    with open_pool(processes) as pool:
+        # A view, which the blocks of the batches leave open
+        with use_pool(SharedPool(pool, workers, Budget()).view(None)):
+            yield
+
+
+def listed_attorneys(queue: WorkQueue, state) -> pd.DataFrame:
+    """Merges the frames of every completed listing unit"""
+    frames = [pd.read_json(io.StringIO(result), orient='records',
+                           dtype=False, convert_dates=False)
+              for _, result in queue.results(f'{state}:list')]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=['href'])
+    return pd.concat(frames, ignore_index=True).drop_duplicates(subset=['href'])
+
+
+def merge(queue: WorkQueue, state, scraper: AttorneysScraper,
+          attorneys: pd.DataFrame) -> pd.DataFrame:
+    """Combines the listing with the details fetched by every node"""
+    details_scraper = scraper._details_scraper
+    with DetailsStore(details_scraper._store_path) as store:
+        store.put_many((page, json.loads(details)) for page, details
+                       in queue.results(f'{state}:details'))
+        details = store.frame(details_scraper._list_urls(attorneys))
+    return scraper.combine_details(attorneys, details)
+
+
+def run(state, queue_path, cache, output=None, batch_size=100,
+        lease_timeout=600.0, poll_interval=5.0, **kwargs):
+    """Works on the units of state until none is left, kwargs go to the scraper"""
+    module = importlib.import_module(f'scrapers.attorneys.{state}')
+    scraper = module.make_scraper(cache, **kwargs)
+    with WorkQueue(queue_path, lease_timeout=lease_timeout) as queue:
+        name = f'{state}:list'
+        queue.add(name, scraper._list_scraper.work_units())
+        queue.drain(name, functools.partial(_list_units, queue, scraper, name),
+                    poll_interval=poll_interval)
+        attorneys = listed_attorneys(queue, state)
+
+        name = f'{state}:details'
+        queue.add(name, scraper._details_scraper._list_urls(attorneys))
+        with _details_pool(scraper):
+            queue.drain(name,
+                        functools.partial(_fetch_units, queue, scraper, name),
+                        batch_size=batch_size, poll_interval=poll_interval)
+        for name in [f'{state}:list', f'{state}:details']:
+            print(f'{name}: {queue.counts(name)}')
+
+        if output is not None:
+            write_frame(merge(queue, state, scraper, attorneys), output)
+    scraper.report_rate_limits()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('state', choices=states)
+    parser.add_argument('queue',
+                        help='work queue file shared by the nodes, on a '
+                             'filesystem with working locks')
+    parser.add_argument('cache', help='cache directory of this node')
+    parser.add_argument('--output', default=None,
+                        help='write the combined output once all units are '
+                             'done: csv file, parquet if it ends with '
+                             '.parquet, or json lines if it ends with .jsonl')
+    parser.add_argument('--processes', default=None,
+                        help="number of worker processes, 'none', or "
+                             "'threads:N' to use a pool of N threads")
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='fetch details with asyncio, keeping this '
+                             'many requests in flight')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='detail pages leased at once')
+    parser.add_argument('--lease-timeout', type=float, default=600.0,
+                        help='seconds after which the units of a worker '
+                             'that stopped are leased again')
+    parser.add_argument('--http-cache', default=None,
+                        help='keep the raw responses in this directory')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, default=None,
+                        metavar='RATE[:BURST]',
+                        help='requests per second of this node to the host')
+    args = parser.parse_args()
+    run(args.state, args.queue, args.cache, output=args.output,
+        batch_size=args.batch_size, lease_timeout=args.lease_timeout,
+        processes=args.processes, concurrency=args.concurrency,
+        http_cache=args.http_cache, rate_limit=args.rate_limit)
@@ -0,0 +1,73 @@
+from typing import Dict, List, Optional, Sequence
+
+import lxml.etree
+import lxml.html
+
+from scrapers.attorneys import metrics, profiling
+
+
+def parse_html(content) -> lxml.html.HtmlElement:
+    """Parses raw page bytes with lxml, without building a soup"""
+    with metrics.timer('parse_seconds', parser='lxml'), \
+            profiling.stage('parse'):
+        return lxml.html.document_fromstring(content)
+
+
+def node_text(node) -> str:
+    """Text of node and its descendants, like bs4's `.text`"""
+    return node.text_content()
+
+
+def css_class(name) -> str:
+    """XPath predicate matching elements having the css class name"""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+
+class FieldsExtractor:
+    """
+    Extracts a {field: stripped text} dict from the first node matching
+    each field's XPath, optionally relative to the node matching `scope`.
+    Fields missing from the page are left out of the dict.
+    """
+
+    def __call__(self, root) -> dict:
+        if self._scope is not None:
+            scopes = self._scope(root)
+            if len(scopes) == 0:
+                return {}
+            root = scopes[0]
+        fields = {}
+        for field, xpath in self._fields.items():
+            nodes = xpath(root)
+            if len(nodes) > 0:
+                fields[field] = node_text(nodes[0]).strip()
+        return fields
+
+    def __init__(self, fields: Dict[str, str], scope: Optional[str] = None):
+        self._fields = {field: lxml.etree.XPath(xpath)
+                        for field, xpath in fields.items()}
+        self._scope = lxml.etree.XPath(scope) if scope is not None else None
+
+
+class RowsExtractor:
+    """
+    Extracts the cell texts of every row matching `rows`, as dicts keyed
+    by `header` when it is given, or as tuples of unstripped texts.
+    """
+
+    def __call__(self, root) -> List:
+        results = []
+        for row in self._rows(root):
+            cells = [node_text(cell) for cell in self._cells(row)]
+            if self._header is None:
+                results.append(tuple(cells))
+            else:
+                results.append({self._header[i]: cell.strip()
+                                for i, cell in enumerate(cells)})
+        return results
+
+    def __init__(self, rows: str, header: Optional[Sequence[str]] = None,
+                 cells: str = './/td'):
+        self._rows = lxml.etree.XPath(rows)
+        self._cells = lxml.etree.XPath(cells)
+        self._header = header
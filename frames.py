@@ -0,0 +1,198 @@
+import hashlib
+import os
+from typing import Iterable, List, Optional
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Low cardinality listing columns, stored dictionary encoded
+categorical_columns = ['status', 'Status', 'city', 'City']
+
+
+def _is_parquet(path) -> bool:
+    return str(path).endswith('.parquet')
+
+
+def _is_jsonl(path) -> bool:
+    return str(path).endswith('.jsonl')
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError('parquet output requires pyarrow')
+
+
+def text_schema(columns: List[str]) -> 'pa.Schema':
+    """Schema of scraped frames: text columns, categoricals dictionary encoded"""
+    return pa.schema([
+        (column, pa.dictionary(pa.int32(), pa.string())
+         if column in categorical_columns else pa.string())
+        for column in columns])
+
+
+def to_arrow(frame: pd.DataFrame, schema: Optional['pa.Schema'] = None) -> 'pa.Table':
+    """Converts a scraped frame, reindexed to schema when given, to arrow"""
+    if schema is None:
+        schema = text_schema([str(column) for column in frame.columns])
+    frame = frame.reindex(columns=schema.names)
+    # Scraped values are text, pandas only turns missing ones into floats
+    frame = frame.astype(object).where(frame.notna(), None)
+    return pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+
+
+def write_frame(frame: pd.DataFrame, path):
+    """
+    Writes an output frame, as parquet when path ends with .parquet,
+    json lines when it ends with .jsonl, and csv otherwise
+    """
+    if _is_jsonl(path):
+        return frame.to_json(path, orient='records', lines=True)
+    if not _is_parquet(path):
+        return frame.to_csv(path)
+    _require_pyarrow()
+    pq.write_table(to_arrow(frame), path)
+
+
+def read_frame(path, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Reads an output frame, memory mapping and projecting parquet files"""
+    if _is_jsonl(path):
+        frame = pd.read_json(path, orient='records', lines=True, dtype=False)
+        return frame if columns is None else frame[columns]
+    if not _is_parquet(path):
+        return pd.read_csv(path, index_col=0, usecols=None if columns is None
+                           else [0] + list(columns))
+    _require_pyarrow()
+    table = pq.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas()
+
+
+class KeyIndex:
+    """
+    Set of the keys seen so far, kept as 64-bit hashes, which take a
+    fraction of the memory of the key strings themselves
+    """
+
+    @staticmethod
+    def _hash(key) -> int:
+        digest = hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def add(self, key) -> bool:
+        """Adds key, returns whether it was new"""
+        key_hash = self._hash(key)
+        if key_hash in self._hashes:
+            return False
+        self._hashes.add(key_hash)
+        return True
+
+    def __contains__(self, key) -> bool:
+        return self._hash(key) in self._hashes
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __init__(self, keys: Iterable = ()):
+        self._hashes = set()
+        for key in keys:
+            self.add(key)
+
+
+class FrameWriter:
+    """
+    Writes an output frame chunk by chunk while scraping, so that memory
+    stays bounded whatever the roster size. Parquet chunks become row
+    groups, and the columns of the first chunk fix the schema of parquet
+    and csv outputs; json lines outputs take any columns. With a key
+    column, rows whose key was already written are dropped.
+    """
+
+    def write(self, chunk: pd.DataFrame):
+        if self._key is not None and self._key in chunk.columns:
+            chunk = chunk.loc[[pd.isna(key) or self._written.add(key)
+                           for key in chunk[self._key]]]
+        if len(chunk) == 0:
+            return
+        if _is_jsonl(self._path):
+            chunk.to_json(self._path, orient='records', lines=True,
+                          mode='a' if self._columns is not None else 'w')
+            self._columns = chunk.columns
+        elif self._columns is None:
+            self._open(chunk)
+        else:
+            dropped = chunk.columns.difference(self._columns)
+            if len(dropped) > 0:
+                print(f'dropping columns missing from the output schema: '
+                      f'{list(dropped)}')
+            chunk = chunk.reindex(columns=self._columns)
+            if self._writer is not None:
+                self._writer.write_table(to_arrow(chunk, self._writer.schema))
+            else:
+                chunk.to_csv(self._path, mode='a', header=False)
+
+    def write_record(self, record: dict):
+        """Buffers a record, written with the next chunk of chunk_size"""
+        self._records.append(record)
+        if len(self._records) >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._records) > 0:
+            records, self._records = self._records, []
+            self.write(pd.DataFrame(records))
+
+    def _open(self, chunk: pd.DataFrame):
+        self._columns = chunk.columns
+        if _is_parquet(self._path):
+            _require_pyarrow()
+            table = to_arrow(chunk)
+            self._writer = pq.ParquetWriter(self._path, table.schema)
+            self._writer.write_table(table)
+        else:
+            chunk.to_csv(self._path)
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __init__(self, path, key: Optional[str] = None, chunk_size: int = 1000):
+        self._path = path
+        self._key = key
+        self._chunk_size = chunk_size
+        self._written = KeyIndex()
+        self._records = []
+        self._columns = None
+        self._writer = None
+
+
+def dump_cache_frame(frame: pd.DataFrame, path):
+    """Dumps a cache frame to path, without extension, as parquet or pickle"""
+    if pa is None:
+        return frame.to_pickle(f'{path}.pkl')
+    frame.to_parquet(f'{path}.parquet')
+
+
+def load_cache_frame(path, columns: Optional[List[str]] = None
+                     ) -> Optional[pd.DataFrame]:
+    """
+    Loads a cache frame dumped by `dump_cache_frame`, reading only the
+    given columns. Falls back to pickles of older caches.
+    """
+    if pa is not None and os.path.exists(f'{path}.parquet'):
+        return pd.read_parquet(f'{path}.parquet', columns=columns,
+                               memory_map=True)
+    if os.path.exists(f'{path}.pkl'):
+        frame = pd.read_pickle(f'{path}.pkl')
+        return frame if columns is None else frame[columns]
+    return None
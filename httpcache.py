@@ -0,0 +1,147 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import NamedTuple, Optional
+
+import requests
+
+
+class CachedResponse(NamedTuple):
+    content: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+
+def request_url(url, params=None) -> str:
+    """The url requested for url and params, which keys the cache"""
+    prepared = requests.models.PreparedRequest()
+    prepared.prepare_url(url, params)
+    return prepared.url
+
+
+class ResponseCache:
+    """
+    Raw response bodies, zlib compressed in files named by the hash of
+    their content, so identical pages are stored once. A SQLite index maps
+    every requested url to its body and to the ETag and Last-Modified
+    validators used to revalidate it. Safe to share between the threads
+    and forked processes of a run.
+    """
+
+    def _conn(self) -> sqlite3.Connection:
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(os.path.join(self.path, 'index.sqlite'),
+                                   timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'url TEXT PRIMARY KEY, digest TEXT NOT NULL, etag TEXT, '
+                'last_modified TEXT, fetched_at REAL NOT NULL)')
+            conn.commit()
+            self._local.pid, self._local.conn = os.getpid(), conn
+        return self._local.conn
+
+    def _object_path(self, digest) -> str:
+        return os.path.join(self.path, 'objects', digest[:2], digest[2:])
+
+    def get(self, url) -> Optional[CachedResponse]:
+        row = self._conn().execute(
+            'SELECT digest, etag, last_modified, fetched_at FROM responses '
+            'WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        digest, etag, last_modified, fetched_at = row
+        try:
+            with open(self._object_path(digest), 'rb') as blob:
+                content = zlib.decompress(blob.read())
+        except FileNotFoundError:
+            return None
+        return CachedResponse(content, etag, last_modified, fetched_at)
+
+    def put(self, url, content: bytes, etag=None, last_modified=None):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Renamed into place, readers never see a partial body
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+            with open(tmp_path, 'wb') as blob:
+                blob.write(zlib.compress(content))
+            os.replace(tmp_path, path)
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO responses '
+            '(url, digest, etag, last_modified, fetched_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (url, digest, etag, last_modified, time.time()))
+        conn.commit()
+
+    def touch(self, url):
+        """Records that the cached response of url was revalidated"""
+        conn = self._conn()
+        conn.execute('UPDATE responses SET fetched_at = ? WHERE url = ?',
+                     (time.time(), url))
+        conn.commit()
+
+    def update(self, url, cached: Optional[CachedResponse], status: int,
+               content: bytes, headers) -> bytes:
+        """
+        Stores a response to a request for url, possibly conditional on
+        cached, and returns its body, the cached one if it was not modified
+        """
+        if status == 304 and cached is not None:
+            self.touch(url)
+            return cached.content
+        if status == 200:
+            self.put(url, content, etag=headers.get('ETag'),
+                     last_modified=headers.get('Last-Modified'))
+        return content
+
+    def is_fresh(self, cached: CachedResponse) -> bool:
+        """Whether cached can be used without revalidating it"""
+        return (self.replay or (self.max_age is not None
+                                and time.time() - cached.fetched_at < self.max_age))
+
+    def __init__(self, path, replay: bool = False,
+                 max_age: Optional[float] = None):
+        """
+        In replay mode responses are only read from the cache. Otherwise
+        cached responses younger than max_age seconds are used as they are,
+        and older ones revalidated with a conditional request.
+        """
+        self.path = path
+        self.replay = replay
+        self.max_age = max_age
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        self._local = threading.local()
+
+
+def conditional_headers(cached: Optional[CachedResponse]) -> dict:
+    """Headers revalidating cached, empty if there is nothing to revalidate"""
+    headers = {}
+    if cached is None:
+        return headers
+    if cached.etag is not None:
+        headers['If-None-Match'] = cached.etag
+    if cached.last_modified is not None:
+        headers['If-Modified-Since'] = cached.last_modified
+    return headers
+
+
+# The response cache of this run, if any; forked workers inherit it
+_cache: Optional[ResponseCache] = None
+
+
+def configure_response_cache(path, replay: bool = False,
+                             max_age: Optional[float] = None):
+    global _cache
+    _cache = ResponseCache(path, replay=replay, max_age=max_age)
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    return _cache
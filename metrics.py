@@ -0,0 +1,275 @@
+"""
+Run metrics: counters, gauges and histograms labelled per host, stage or
+cache, kept in memory by every process of a run and flushed to one JSON
+file per pid, which the report merges. Recording is a no-op until
+`configure_metrics` is called.
+"""
+import contextlib
+import glob
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+# Upper bounds, in seconds, of the latency histogram buckets
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+# Seconds between flushes of a process's metrics to its file
+flush_interval = 1.0
+
+_dir: Optional[str] = None
+_labels: Dict[str, str] = {}
+_lock = threading.Lock()
+# Held while a thread writes the process's file, which they all share
+_flush_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+# Latest value of each gauge with the time it was set, the newest wins
+# when merging the processes
+_gauges: Dict[str, list] = {}
+_histograms: Dict[str, dict] = {}
+_stages: Dict[str, dict] = {}
+_flushed_at = 0.0
+
+
+def _key(name, labels: dict) -> str:
+    """Prometheus style series name, such as requests_total{host="a"}"""
+    labels = {**_labels, **labels}
+    if len(labels) == 0:
+        return name
+    pairs = ','.join(f'{label}="{value}"'
+                     for label, value in sorted(labels.items()))
+    return f'{name}{{{pairs}}}'
+
+
+def _after_fork():
+    # Forked workers start empty, their parent flushes its own series
+    global _lock, _flush_lock, _counters, _gauges, _histograms, _stages
+    _lock, _flush_lock = threading.Lock(), threading.Lock()
+    _counters, _gauges, _histograms, _stages = {}, {}, {}, {}
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def inc(name, value: float = 1, **labels):
+    """Adds value to a counter"""
+    if _dir is None:
+        return
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+    _maybe_flush()
+
+
+def gauge(name, value: float, **labels):
+    """Sets a gauge to value"""
+    if _dir is None:
+        return
+    with _lock:
+        _gauges[_key(name, labels)] = [value, time.time()]
+    _maybe_flush()
+
+
+def observe(name, value: float, **labels):
+    """Records value, in seconds, in a histogram"""
+    if _dir is None:
+        return
+    with _lock:
+        key = _key(name, labels)
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = {'buckets': [0] * len(buckets), 'count': 0, 'sum': 0.0}
+            _histograms[key] = histogram
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['count'] += 1
+        histogram['sum'] += value
+    _maybe_flush()
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """Observes the seconds spent in the block"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def _maybe_flush():
+    if time.monotonic() - _flushed_at >= flush_interval:
+        flush()
+
+
+def flush():
+    """Writes the metrics of this process to its file"""
+    global _flushed_at
+    if _dir is None:
+        return
+    # Also keeps an older state from replacing a newer one
+    with _flush_lock:
+        with _lock:
+            _flushed_at = time.monotonic()
+            state = json.dumps({'counters': _counters, 'gauges': _gauges,
+                                'histograms': _histograms, 'stages': _stages})
+        path = os.path.join(_dir, f'metrics-{os.getpid()}.json')
+        with open(f'{path}.tmp', 'w') as metrics_file:
+            metrics_file.write(state)
+        os.replace(f'{path}.tmp', path)
+
+
+def init_worker():
+    """
+    Pool initializer flushing the worker's metrics when it exits. A pool
+    that terminates its workers skips this, losing their last interval.
+    """
+    if _dir is not None:
+        multiprocessing.util.Finalize(None, flush, exitpriority=0)
+
+
+def configure_metrics(metrics_dir, **labels):
+    """
+    Starts recording metrics of a run into metrics_dir, labelled with
+    labels. Must be called before the worker pools are started.
+    """
+    global _dir, _labels, _counters, _gauges, _histograms, _stages
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, 'metrics-*.json')):
+        os.remove(path)
+    with _lock:
+        _dir, _labels = metrics_dir, labels
+        _counters, _gauges, _histograms, _stages = {}, {}, {}, {}
+
+
+def snapshot() -> dict:
+    """Merges the metrics flushed by every process of the run"""
+    flush()
+    merged = {'counters': {}, 'gauges': {}, 'histograms': {}, 'stages': {}}
+    for path in glob.glob(os.path.join(_dir, 'metrics-*.json')):
+        try:
+            with open(path) as metrics_file:
+                state = json.load(metrics_file)
+        except (OSError, ValueError):
+            continue
+        for key, value in state['counters'].items():
+            merged['counters'][key] = merged['counters'].get(key, 0) + value
+        for key, (value, set_at) in state['gauges'].items():
+            if set_at >= merged['gauges'].get(key, (None, 0.0))[1]:
+                merged['gauges'][key] = (value, set_at)
+        for key, histogram in state['histograms'].items():
+            total = merged['histograms'].setdefault(
+                key, {'buckets': [0] * len(buckets), 'count': 0, 'sum': 0.0})
+            total['buckets'] = [a + b for a, b in
+                                zip(total['buckets'], histogram['buckets'])]
+            total['count'] += histogram['count']
+            total['sum'] += histogram['sum']
+        merged['stages'].update(state['stages'])
+    merged['gauges'] = {key: value
+                        for key, (value, _) in merged['gauges'].items()}
+    return merged
+
+
+def _total(counters: dict, name) -> float:
+    return sum(value for key, value in counters.items()
+               if key == name or key.startswith(name + '{'))
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times a stage of the run and records the requests and bytes of all
+    processes during it, giving its pages per second
+    """
+    if _dir is None:
+        yield
+        return
+    before = snapshot()['counters']
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        after = snapshot()['counters']
+        requests = (_total(after, 'requests_total')
+                    - _total(before, 'requests_total'))
+        with _lock:
+            _stages[_key(name, {})] = {
+                'seconds': seconds, 'requests': requests,
+                'bytes': (_total(after, 'bytes_total')
+                          - _total(before, 'bytes_total')),
+                'pages_per_sec': requests / seconds if seconds > 0 else 0.0}
+        flush()
+
+
+def _quantile(histogram: dict, q: float) -> Optional[float]:
+    """Upper bound of the bucket holding the q quantile"""
+    rank, seen = q * histogram['count'], 0
+    for bound, count in zip(buckets, histogram['buckets']):
+        seen += count
+        if seen >= rank and count > 0:
+            return bound
+    return None
+
+
+def report() -> dict:
+    """The run report: merged series plus latency quantiles and cache ratios"""
+    merged = snapshot()
+    latencies = {key: {'count': histogram['count'],
+                       'mean': histogram['sum'] / histogram['count'],
+                       'p50': _quantile(histogram, 0.5),
+                       'p99': _quantile(histogram, 0.99)}
+                 for key, histogram in merged['histograms'].items()
+                 if histogram['count'] > 0}
+    counters = merged['counters']
+    caches = {}
+    for cache in ('response', 'frame'):
+        hits = _total(counters, f'{cache}_cache_hits_total')
+        misses = _total(counters, f'{cache}_cache_misses_total')
+        if hits + misses > 0:
+            caches[cache] = {'hits': hits, 'misses': misses,
+                             'hit_ratio': hits / (hits + misses)}
+    return {'labels': _labels, 'stages': merged['stages'],
+            'counters': counters, 'gauges': merged['gauges'],
+            'latencies': latencies, 'caches': caches}
+
+
+def write_report(path=None, prometheus_path=None):
+    """
+    Writes the JSON run report, to report.json in the metrics directory
+    by default, and the series in Prometheus text format if asked
+    """
+    if _dir is None:
+        return
+    run_report = report()
+    with open(path or os.path.join(_dir, 'report.json'), 'w') as report_file:
+        json.dump(run_report, report_file, indent=2)
+    if prometheus_path is not None:
+        with open(prometheus_path, 'w') as prom_file:
+            prom_file.write(prometheus_text(snapshot()))
+
+
+def prometheus_text(merged: dict) -> str:
+    """Formats merged series in the Prometheus text exposition format"""
+    lines = []
+    for key, value in sorted(merged['counters'].items()):
+        lines.append(f'{key} {value}')
+    for key, value in sorted(merged['gauges'].items()):
+        lines.append(f'{key} {value}')
+    for key, histogram in sorted(merged['histograms'].items()):
+        name, _, labels = key.partition('{')
+        labels = labels.rstrip('}')
+        cumulative = 0
+        for bound, count in zip(buckets, histogram['buckets']):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else str(bound)
+            bucket_labels = f'{labels},le="{le}"' if labels else f'le="{le}"'
+            lines.append(f'{name}_bucket{{{bucket_labels}}} {cumulative}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_count{suffix} {histogram["count"]}')
+        lines.append(f'{name}_sum{suffix} {histogram["sum"]}')
+    return '\n'.join(lines) + '\n'
@@ -8,21 +8,57 @@ from selenium.webdriver.support import expected_conditions
 from selenium.common.exceptions import NoSuchElementException, TimeoutException
 from selenium.webdriver.firefox.options import Options
 
+import lxml.etree
+
+import concurrent.futures
+import contextlib
 import pickle
 import os
 import itertools
+import json
 import string
 import time
 import functools
 import traceback
 import multiprocessing as mp
+import multiprocessing.util
+from typing import Iterator, List, Optional, Tuple
 from tqdm.auto import tqdm
 
+from scrapers.attorneys import metrics, profiling
+from scrapers.attorneys.base import (
+    open_executor, process_rss_mb, run_stage, safe_get_content)
+from scrapers.attorneys.concurrency import configure_adaptive_limits
+from scrapers.attorneys.extract import css_class, node_text, parse_html
+from scrapers.attorneys.frames import FrameWriter
+from scrapers.attorneys.prefixes import PrefixIndex, search_prefixes
+from scrapers.attorneys.workqueue import WorkQueue
+from scrapers.attorneys.ratelimit import (
+    configure_rate_limits, rate_limit_stats, throttle)
+
+search_url = 'https://iapps.courts.state.ny.us/attorneyservices/search'
+host = 'iapps.courts.state.ny.us'
+# searches per second and burst allowed by the court site
+rate_limits = {host: (2.0, 4)}
+
+# Work queue of the terms, when several nodes share the search
+queue_name = 'new_york:terms'
+# Detail label identifying an attorney listed by several terms
+registration_label = 'Registration Number:'
+
+detail_rows_xpath = lxml.etree.XPath(
+    f'//*[{css_class("CONT_Default")}]//*[{css_class("CONT_Row")}]')
+detail_cells_xpath = lxml.etree.XPath(f'.//*[{css_class("CONT_Cell")}]')
+
 
 class NYScraperError(Exception):
     pass
 
 
+class TermOverflow(NYScraperError):
+    """Raised when a term lists more results than it may, to be split"""
+
+
 def enter_search(driver, first, last):
     first_name = WebDriverWait(driver, 30).until(
         expected_conditions.presence_of_element_located((
@@ -48,7 +84,8 @@ def second_window_opened(driver):
     return True
 
 
-def scrape_one_page(driver, skip_wait=False):
+def results_body(driver, skip_wait=False):
+    """Waits for the table of the results page, None if nothing was found"""
     if not skip_wait:
         try:
             error_box = WebDriverWait(driver, 2).until(
@@ -57,7 +94,7 @@ def scrape_one_page(driver, skip_wait=False):
                 ))
             )
             if error_box is not None:
-                return []
+                return None
             raise NYScraperError('unexpected error')
         except TimeoutException as te:
             try:
@@ -70,6 +107,51 @@ def scrape_one_page(driver, skip_wait=False):
                 By.TAG_NAME, 'tbody'
             ))
         )
+    return tbody
+
+
+def next_button(driver):
+    """The button to the next results page, None on the last page"""
+    try:
+        next_btn = driver.find_element(By.CLASS_NAME, 'next')
+    except NoSuchElementException:
+        return None
+    if (next_btn.get_attribute('disabled') or 'false') != 'false':
+        return None
+    return next_btn
+
+
+def check_overflow(driver, first, last, max_results) -> bool:
+    """
+    Pages through the results of the term entered in driver, counting the
+    attorneys listed without opening any, and raises TermOverflow once
+    more than max_results are. Returns whether it left the first page.
+    """
+    listed, skip_wait = 0, False
+    while True:
+        tbody = results_body(driver, skip_wait=skip_wait)
+        if tbody is None:
+            return skip_wait
+        listed += len(tbody.find_elements(By.XPATH, './/tr[.//a]'))
+        if listed > max_results:
+            raise TermOverflow(f'{first}-{last} lists more than '
+                               f'{max_results} attorneys')
+        next_btn = next_button(driver)
+        if next_btn is None:
+            return skip_wait
+        next_btn.click()
+        skip_wait = True
+
+
+def scrape_one_page(driver, skip_wait=False, links_only=False):
+    """
+    Scrapes the details of every attorney listed on the results page by
+    opening their detail window, or only returns the detail page urls if
+    links_only, except for rows without a plain link.
+    """
+    tbody = results_body(driver, skip_wait=skip_wait)
+    if tbody is None:
+        return []
 
     # presence_of_all_elements_located
     trs = tbody.find_elements(By.TAG_NAME, 'tr')
@@ -80,6 +162,10 @@ def scrape_one_page(driver, skip_wait=False):
             a = tr.find_element(By.TAG_NAME, 'a')
         except NoSuchElementException:
             continue
+        href = a.get_attribute('href') if links_only else None
+        if href is not None and href.startswith('http'):
+            attorneys.append(href)
+            continue
         a.click()
 
         (WebDriverWait(driver, 30, ignored_exceptions=[NYScraperError])
@@ -107,7 +193,119 @@ def scrape_one_page(driver, skip_wait=False):
     return attorneys
 
 
-def search_one_term(first, last, cache):
+def parse_attorney_details(content) -> dict:
+    """Parses a detail page fetched over HTTP, like `scrape_one_page`"""
+    details = {}
+    for row in detail_rows_xpath(parse_html(content)):
+        cells = detail_cells_xpath(row)
+        if len(cells) != 2:
+            continue
+        details[node_text(cells[0]).strip()] = node_text(cells[1]).strip()
+    return details
+
+
+def attorney_details(page_url, cookies, headers) -> dict:
+    content = safe_get_content(page_url, cookies=cookies, headers=headers)
+    return parse_attorney_details(content)
+
+
+class Browser:
+    """
+    A long-lived headless Firefox, kept by a worker across terms. It is
+    reset to the search page before every term, and recycled after
+    max_terms terms, after a failed term, or once it uses more than
+    max_rss_mb of memory.
+    """
+
+    def driver(self) -> webdriver.Firefox:
+        if self._driver is None:
+            options = Options()
+            options.headless = True
+            self._driver = webdriver.Firefox(options=options)
+            self._terms = 0
+        return self._driver
+
+    def reset(self) -> webdriver.Firefox:
+        """Closes the detail windows left over and opens the search page"""
+        driver = self.driver()
+        for handle in driver.window_handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(driver.window_handles[0])
+        throttle(search_url)
+        driver.get(search_url)
+        return driver
+
+    def rss_mb(self) -> float:
+        if self._driver is None:
+            return 0.0
+        return process_rss_mb(self._driver.service.process.pid)
+
+    def term_done(self):
+        self._terms += 1
+        if (self._terms >= self._max_terms
+                or (self._max_rss_mb is not None
+                    and self.rss_mb() > self._max_rss_mb)):
+            self.recycle()
+
+    def recycle(self):
+        if self._driver is None:
+            return
+        try:
+            self._driver.quit()
+        except Exception:
+            traceback.print_exc()
+        self._driver = None
+
+    def details_fetcher(self, threads) -> '_DetailsFetcher':
+        """The fetcher of detail pages, kept across terms and browsers"""
+        if self._fetcher is None:
+            self._fetcher = _DetailsFetcher(threads)
+        return self._fetcher
+
+    def close(self):
+        """Quits the browser and stops the fetcher, once the worker is done"""
+        self.recycle()
+        if self._fetcher is not None:
+            self._fetcher.close()
+            self._fetcher = None
+
+    def __init__(self, max_terms: int = 200, max_rss_mb: Optional[float] = None):
+        self._driver = None
+        self._fetcher = None
+        self._terms = 0
+        self._max_terms = max_terms
+        self._max_rss_mb = max_rss_mb
+
+
+# The browser of this worker process, see `init_browser`
+_browser = None
+
+
+def init_browser(max_terms=200, max_rss_mb=None):
+    """Pool initializer giving the worker a browser, quit when it exits"""
+    global _browser
+    _browser = Browser(max_terms=max_terms, max_rss_mb=max_rss_mb)
+    mp.util.Finalize(_browser, _browser.close, exitpriority=10)
+    metrics.init_worker()
+    profiling.init_worker()
+
+
+def get_browser() -> Browser:
+    if _browser is None:
+        init_browser()
+    return _browser
+
+
+def search_one_term(first, last, cache, detail_threads=None, max_results=None):
+    """
+    Searches a term in the worker's browser. With detail_threads, the
+    browser only pages through the results, and detail pages are fetched
+    over HTTP on that many threads with the browser's session cookies.
+    Raises TermOverflow when more than max_results attorneys are listed,
+    found by a first pass over the results before any detail is opened
+    or fetched.
+    """
     fname = f'{first}-{last}.pkl'
     cache_path = os.path.join(cache, fname)
 
@@ -115,34 +313,93 @@ def search_one_term(first, last, cache):
         with open(cache_path, 'rb') as pkl:
             return pickle.load(pkl)
 
-    options = Options()
-    options.headless = True
-    driver = webdriver.Firefox(options=options)
-
+    browser = get_browser()
+    links_only = detail_threads is not None
     try:
-        driver.get('https://iapps.courts.state.ny.us/attorneyservices/search')
+        driver = browser.reset()
         enter_search(driver, first, last)
-
-        term_attorneys, next_disabled, skip_wait = [], 'false', False
-        while next_disabled == 'false':
-            page_attorneys = scrape_one_page(driver, skip_wait=skip_wait)
-            term_attorneys.extend(page_attorneys)
-            try:
-                next_btn = driver.find_element(By.CLASS_NAME, 'next')
-            except NoSuchElementException:
-                next_disabled = 'true'
-                continue
-            next_disabled = next_btn.get_attribute('disabled') or 'false'
-            if next_disabled == 'false':
+        if (max_results is not None
+                and check_overflow(driver, first, last, max_results)):
+            # Back to the first results page
+            driver = browser.reset()
+            enter_search(driver, first, last)
+
+        term_attorneys, skip_wait = [], False
+        fetcher = (browser.details_fetcher(detail_threads).term(driver)
+                   if links_only else contextlib.nullcontext())
+        with fetcher:
+            while True:
+                page_attorneys = scrape_one_page(driver, skip_wait=skip_wait,
+                                                 links_only=links_only)
+                if links_only:
+                    # Fetched while the browser moves on to the next page
+                    fetcher.submit(page_attorneys)
+                else:
+                    term_attorneys.extend(page_attorneys)
+                next_btn = next_button(driver)
+                if next_btn is None:
+                    break
                 next_btn.click()
-            skip_wait = True
-
-        print(f'writing {fname}, size {len(term_attorneys)}')
-        with open(cache_path, 'wb') as pkl:
-            pickle.dump(term_attorneys, pkl)
-        return term_attorneys
-    finally:
-        driver.quit()
+                skip_wait = True
+            if links_only:
+                term_attorneys = fetcher.results()
+    except TermOverflow:
+        browser.term_done()
+        raise
+    except Exception:
+        # The browser may be left in any state, start the retry afresh
+        browser.recycle()
+        raise
+    browser.term_done()
+
+    print(f'writing {fname}, size {len(term_attorneys)}')
+    with open(cache_path, 'wb') as pkl:
+        pickle.dump(term_attorneys, pkl)
+    return term_attorneys
+
+
+class _DetailsFetcher:
+    """
+    Fetches detail pages over HTTP with the cookies of a browser session,
+    on threads kept for all the terms of a worker
+    """
+
+    @contextlib.contextmanager
+    def term(self, driver):
+        """Fetches the details of one term with the session of driver"""
+        self._cookies = {cookie['name']: cookie['value']
+                         for cookie in driver.get_cookies()}
+        self._headers = {
+            'User-Agent': driver.execute_script('return navigator.userAgent'),
+            'Referer': driver.current_url}
+        self._results = []
+        try:
+            yield self
+        finally:
+            # Fetches a failed term did not wait for are dropped
+            for result in self._results:
+                if isinstance(result, concurrent.futures.Future):
+                    result.cancel()
+            self._results = []
+
+    def submit(self, attorneys: list):
+        """Starts fetching the detail page urls among attorneys"""
+        for attorney in attorneys:
+            if isinstance(attorney, str):
+                attorney = self._executor.submit(
+                    attorney_details, attorney, self._cookies, self._headers)
+            self._results.append(attorney)
+
+    def results(self) -> list:
+        return [result.result() if isinstance(result, concurrent.futures.Future)
+                else result for result in self._results]
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+    def __init__(self, threads):
+        self._executor = open_executor(f'threads:{threads}')
+        self._cookies, self._headers, self._results = {}, {}, []
 
 
 def robust_wrapper(args, func):
@@ -150,6 +407,8 @@ def robust_wrapper(args, func):
     while results is None and i > 0:
         try:
             results = func(*args)
+        except TermOverflow:
+            raise
         except Exception as ex:
             i -= 1
             traceback.print_exc()
@@ -158,42 +417,199 @@ def robust_wrapper(args, func):
     return results
 
 
-def make_iterator(cache):
-    looper = itertools.product(string.ascii_lowercase,
-                               string.ascii_lowercase,
-                               string.ascii_lowercase)
-    for x1, x2, x3 in looper:
-        first, last = x1, x2 + x3
-        args = (first, last, cache)
-        yield args
-
-
-def main(cache, output, multiproc=False):
+def root_terms() -> List[str]:
+    """Coarsest terms searched, a first and a last name initial"""
+    return [f'{first}-{last}' for first, last
+            in itertools.product(string.ascii_lowercase, repeat=2)]
+
+
+def expand_term(term) -> List[str]:
+    """Splits a term by lengthening its shorter name by every letter"""
+    first, last = term.split('-')
+    if len(last) <= len(first):
+        return [f'{first}-{last + letter}' for letter in string.ascii_lowercase]
+    return [f'{first + letter}-{last}' for letter in string.ascii_lowercase]
+
+
+def search_term(term, cache, detail_threads=None, max_results=None,
+                max_length=6) -> Tuple[list, bool]:
+    """
+    Searches a 'first-last' term, returning its attorneys and whether it
+    overflowed max_results. Terms of max_length letters are never split.
+    Attorneys whose searches keep failing are left out, as by main.
+    """
+    first, last = term.split('-')
+    if len(first) + len(last) >= max_length:
+        max_results = None
+    search = functools.partial(search_one_term, detail_threads=detail_threads,
+                               max_results=max_results)
+    try:
+        attorneys = robust_wrapper((first, last, cache), search)
+    except TermOverflow:
+        metrics.inc('term_overflows_total')
+        return [], True
+    metrics.inc('terms_total')
+    return attorneys or [], False
+
+
+def _write_attorneys(resolved, writer: FrameWriter):
+    """Writes the attorneys of terms as they resolve"""
+    for _, attorneys in tqdm(resolved):
+        for attorney in attorneys:
+            writer.write_record(attorney)
+
+
+def _search_queued_terms(queue_path, search, lease_timeout, _worker=None):
+    """Searches the terms leased from the shared queue until none is left"""
+    with WorkQueue(queue_path, lease_timeout=lease_timeout) as queue:
+        def process(terms):
+            for term in terms:
+                attorneys, overflow = search(term)
+                if overflow:
+                    # Added before the term completes, so that no worker
+                    # sees the queue drained in between
+                    queue.add(queue_name, expand_term(term))
+                result = None if overflow else json.dumps(attorneys)
+                queue.complete(queue_name, [(term, result)])
+        queue.drain(queue_name, process)
+
+
+def _queued_attorneys(queue_path) -> Iterator[Tuple[str, list]]:
+    with WorkQueue(queue_path) as queue:
+        for term, result in queue.results(queue_name):
+            if result is not None:
+                yield term, json.loads(result)
+
+
+def main(cache, output, multiproc=False, browsers=None, browser_terms=200,
+         max_memory=None, detail_threads=None, max_results=100, queue=None,
+         lease_timeout=1800.0, metrics_dir=None, prometheus=None,
+         profile_dir=None, adaptive=False):
+    """
+    Searches the terms with one long-lived browser per worker, or a single
+    browser unless multiproc. max_memory, in MB, is shared by the browsers.
+    With detail_threads, detail pages are fetched over HTTP, adapting
+    the requests in flight to the host if adaptive.
+
+    Terms start from name initials, and a term listing more than
+    max_results attorneys is split into longer ones, searched concurrently
+    with all other pending terms. The terms that had to be split are kept
+    in a term index, so later runs search their narrower terms directly.
+    Attorneys are written in chunks as terms resolve, once per
+    registration number.
+
+    With a queue file shared by several nodes, the terms are leased from
+    it instead, split terms are added to it, and every node writes the
+    attorneys of all nodes once no term is left.
+    """
     if not os.path.exists(cache):
         os.mkdir(cache)
-
-    func = functools.partial(robust_wrapper, func=search_one_term)
-    looper, results = make_iterator(cache), []
-
-    if multiproc:
-        pool = mp.Pool(processes=int(4 * mp.cpu_count()))
-        for result in tqdm(pool.imap_unordered(func, looper), total=26 ** 3):
-            if isinstance(result, list):
-                results.extend(result)
-    else:
-        for args_ in tqdm(looper, total=26 ** 3):
-            result = func(args_)
-            if isinstance(result, list):
-                results.extend(result)
-
-    import pandas as pd
-    pd.DataFrame(results).to_csv(output)
+    configure_rate_limits(rate_limits, os.path.join(cache, 'ratelimit'))
+    if metrics_dir is not None:
+        metrics.configure_metrics(metrics_dir, state='new_york')
+    if profile_dir is not None:
+        profiling.configure_profiling(profile_dir)
+
+    search = functools.partial(search_term, cache=cache,
+                               detail_threads=detail_threads,
+                               max_results=max_results)
+    index = PrefixIndex(os.path.join(cache, 'terms.sqlite'))
+
+    browsers = (browsers or mp.cpu_count()) if multiproc else 1
+    if adaptive and detail_threads is not None:
+        configure_adaptive_limits(rate_limits,
+                                  os.path.join(cache, 'concurrency'),
+                                  max_limit=browsers * detail_threads)
+    max_rss_mb = max_memory / browsers if max_memory is not None else None
+    writer = FrameWriter(output, key=registration_label)
+    with run_stage('search'):
+        if queue is not None:
+            with WorkQueue(queue) as work_queue:
+                work_queue.add(queue_name, root_terms())
+            work = functools.partial(_search_queued_terms, queue, search,
+                                     lease_timeout)
+            if multiproc:
+                pool = mp.Pool(processes=browsers, initializer=init_browser,
+                               initargs=(browser_terms, max_rss_mb))
+                pool.map(work, range(browsers))
+                pool.close()
+                pool.join()
+            else:
+                init_browser(browser_terms, max_rss_mb)
+                work()
+                _browser.close()
+            _write_attorneys(_queued_attorneys(queue), writer)
+        elif multiproc:
+            pool = mp.Pool(processes=browsers, initializer=init_browser,
+                           initargs=(browser_terms, max_rss_mb))
+            _write_attorneys(search_prefixes(
+                search, expand_term, root_terms(), pool=pool, index=index),
+                writer)
+            # Lets the workers exit, so that they quit their browsers
+            pool.close()
+            pool.join()
+        else:
+            init_browser(browser_terms, max_rss_mb)
+            _write_attorneys(search_prefixes(
+                search, expand_term, root_terms(), index=index), writer)
+            _browser.close()
+    with run_stage('write'):
+        writer.close()
+    index.close()
+    metrics.write_report(prometheus_path=prometheus)
+    profiling.write_profiles()
+
+    for host, stats in rate_limit_stats().items():
+        print(f'{host}: {stats["requests"]} searches waited '
+              f'{stats["waited"]:.1f} seconds for the rate limit')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('cache')
-    parser.add_argument('output')
+    parser.add_argument('output',
+                        help='csv file, parquet if it ends with .parquet, or '
+                             'json lines if it ends with .jsonl, which keeps '
+                             'details labels missing from the first chunk')
     parser.add_argument('--multiproc', action='store_true')
+    parser.add_argument('--browsers', type=int, default=None,
+                        help='with --multiproc, number of browsers searching '
+                             'at once, defaults to the cpu count')
+    parser.add_argument('--browser-terms', type=int, default=200,
+                        help='restart a browser after this many terms')
+    parser.add_argument('--max-memory', type=float, default=None,
+                        help='MB of memory shared by the browsers, a browser '
+                             'using more than its share is restarted')
+    parser.add_argument('--max-results', type=int, default=100,
+                        help='split terms listing more attorneys than this '
+                             'into longer terms')
+    parser.add_argument('--queue', default=None,
+                        help='work queue file shared with the other nodes, '
+                             'on a filesystem with working locks')
+    parser.add_argument('--lease-timeout', type=float, default=1800.0,
+                        help='with --queue, seconds after which the term of '
+                             'a worker that stopped is leased again')
+    parser.add_argument('--detail-threads', type=int, default=None,
+                        help='fetch detail pages over HTTP on this many '
+                             'threads per browser, instead of opening them '
+                             'in the browser')
+    parser.add_argument('--metrics', default=None,
+                        help='record request, term and stage metrics in '
+                             'this directory and write report.json there')
+    parser.add_argument('--prometheus', default=None,
+                        help='with --metrics, also write the metrics to '
+                             'this file in the Prometheus text format')
+    parser.add_argument('--profile', default=None,
+                        help='sample the stacks of every process and write '
+                             'per-stage flame graph input to this directory')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='with --detail-threads, adapt the detail '
+                             'requests in flight to the latency and errors '
+                             'of the host')
     args = parser.parse_args()
-    main(args.cache, args.output, args.multiproc)
+    main(args.cache, args.output, args.multiproc, browsers=args.browsers,
+         browser_terms=args.browser_terms, max_memory=args.max_memory,
+         detail_threads=args.detail_threads, max_results=args.max_results,
+         queue=args.queue, lease_timeout=args.lease_timeout,
+         metrics_dir=args.metrics, prometheus=args.prometheus,
+         profile_dir=args.profile, adaptive=args.adaptive)
@@ -1,18 +1,36 @@
 import argparse
+import os
 import pandas as pd
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 import re
 
+import lxml.etree
+import lxml.html
+
+from tqdm.auto import tqdm
+
 from scrapers.attorneys.base import (
-    safe_get_soup, AttorneysScraper, ListByLettersScraper, DetailsScraper)
+    letters, open_pool, safe_get_content, AttorneysScraper,
+    ListByLettersScraper, DetailsScraper, add_scraper_arguments,
+    write_scraped)
+from scrapers.attorneys.extract import (
+    RowsExtractor, css_class, node_text, parse_html)
+from scrapers.attorneys.frames import load_cache_frame
 
 search_url = 'https://www.osbar.org/members/membersearch.asp'
 member_url = 'https://www.osbar.org/members/membersearch_display.asp'
+# Host of the bar site, rate limited only when given a rate_limit
+host = 'www.osbar.org'
 
+paging_xpath = lxml.etree.XPath(
+    f'(//*[{css_class("pagingheader")}])[1]//h3')
+rows_extractor = RowsExtractor(
+    '(//table[@id="tblResults"])[1]/descendant::tbody[1]//tr')
+member_table_xpath = lxml.etree.XPath('//table[@id="tbl_member"]')
 
-def _get_page_count(soup):
-    texts = list(map(lambda x: x.text,
-                     soup.find(class_='pagingheader').findAll('h3')))
+
+def _get_page_count(root):
+    texts = list(map(node_text, paging_xpath(root)))
     for text in texts:
         match = re.match(r'^Page\s(?P<cur>\d+)\sof\s(?P<tot>\d+)$', text)
         if match is None:
@@ -22,127 +40,152 @@ def _get_page_count(soup):
     return None
 
 
-def _page_rows(soup) -> list:
-    trs = (soup.find('table', id='tblResults')
-           .find('tbody').findAll('tr'))
-    rows = []
-    for tr in trs:
-        rows.append(tuple(td.text for td in tr.findAll('td')))
-    return rows
+def _page_rows(root) -> list:
+    return rows_extractor(root)
 
 
 def _fetch_list_rows(letter, cp):
-    soup = None
+    root = None
     try:
         params = {'last': letter, 'cp': cp}
-        soup = safe_get_soup(search_url, params=params)
-        return _page_rows(soup)
+        root = parse_html(safe_get_content(search_url, params=params))
+        return _page_rows(root)
     except Exception as ex:
         print(f'error fetching {letter}, {cp}')
-        if soup is None:
+        if root is None:
             raise ex
-        with open(f'/tmp/{letter}-{cp}.html') as html:
-            html.write(soup.prettify())
+        with open(f'/tmp/{letter}-{cp}.html', 'wb') as html:
+            html.write(lxml.html.tostring(root, pretty_print=True))
         raise ex
 
 
-def _compare_row_letter(row, letter) -> int:
-    lhs, rhs = row[1][0].lower(), letter[0].lower()
-    comp = ord(lhs) - ord(rhs)
-    if comp == 0:
-        return comp
-    return comp // abs(comp)
-
-
-def _find_letter_start_page(letter, start, end) -> int:
-    """Binary search through pages to identify the start page"""
-    if start == end:
-        return start
-
-    mid = (start + end) // 2
-    rows = _fetch_list_rows(letter, mid)
-
-    first_comp = _compare_row_letter(rows[0], letter)
-    last_comp = _compare_row_letter(rows[-1], letter)
+def _row_initial(row) -> str:
+    return row[1][0].lower()
 
-    if first_comp == last_comp >= 0:
-        return _find_letter_start_page(letter, start, mid)
 
-    if first_comp == last_comp < 0:
-        return _find_letter_start_page(letter, mid + 1, end)
-
-    if first_comp < last_comp == 0:
-        return mid
-
-    if first_comp < last_comp > 0:
-        return _find_letter_start_page(letter, start, mid)
-
-    raise Exception(f'check binary search {letter}, {start}, {end}')
-
-
-def _fetch_letter_list(letter, start_page, n_total) -> list:
-    rows = _fetch_list_rows(letter, start_page)
-    letter_rows = []
-    for row in rows:
-        if _compare_row_letter(row, letter) == 0:
-            letter_rows.append(row)
+class OregonListByLetters(ListByLettersScraper):
+    """
+    Lists the Oregon roster, which is listed whole in surname order.
+    A page index, mapping every page to the surname initials of its
+    first and last rows, is built once per run from pages fetched
+    concurrently; letter workers then walk only the cached pages that
+    hold their letter, so every page is downloaded at most once.
+    """
+    key_column = 'bar_num'
+    watch_columns = ['name', 'city']
+    columns = ['bar_num', 'name', 'city']
+    # Any query lists the whole roster, this one is used for all pages
+    roster_query = 'a'
+
+    def _fetch_roster_page(self, page) -> Tuple[int, str, str]:
+        """Fetches and caches a roster page, returns its index entry"""
+        rows = _fetch_list_rows(self.roster_query, page)
+        frame = pd.DataFrame(rows, columns=self.columns)
+        self._cache_dump_term_frame(f'roster-{page}', frame)
+        if len(rows) == 0:
+            return page, '', ''
+        return page, _row_initial(rows[0]), _row_initial(rows[-1])
+
+    def _roster_page(self, page) -> pd.DataFrame:
+        # Read directly, the index of this run cached every page even on refresh
+        path = os.path.join(self._cache_path, f'roster-{page}')
+        frame = load_cache_frame(path)
+        if frame is None:
+            self._fetch_roster_page(page)
+            frame = load_cache_frame(path)
+        return frame
 
-    if start_page == n_total:
-        return letter_rows
+    def _roster_pages(self) -> range:
+        params = {'last': self.roster_query, 'cp': 1}
+        root = parse_html(safe_get_content(search_url, params=params))
+        return range(1, _get_page_count(root) + 1)
+
+    def _build_roster_index(self) -> pd.DataFrame:
+        if self._index is not None:
+            return self._index
+        index = self._cache_load_term_frame('roster-index')
+        if index is not None:
+            self._index = index
+            return index
+
+        pages = self._roster_pages()
+        if self._processes is not None:
+            with open_pool(self._processes) as pool:
+                entries = list(tqdm(pool.imap_unordered(
+                    self._fetch_roster_page, pages), total=len(pages)))
+        else:
+            entries = [self._fetch_roster_page(page) for page in tqdm(pages)]
+        index = (pd.DataFrame(entries, columns=['page', 'first', 'last'])
+                 .sort_values('page', ignore_index=True))
+        self._cache_dump_term_frame('roster-index', index)
+        self._index = index
+        return index
 
-    if _compare_row_letter(rows[-1], letter) > 0:
-        return letter_rows
+    def _list_by_letter_internal(self, letter) -> pd.DataFrame:
+        index = self._build_roster_index()
+        letter_pages = index[(index['first'] <= letter) & (letter <= index['last'])]
+        frames = []
+        for page in letter_pages['page']:
+            frame = self._roster_page(page)
+            frames.append(frame[frame['name'].str[0].str.lower() == letter])
+        frame = pd.concat(frames, ignore_index=True) if len(frames) > 0 \
+            else pd.DataFrame(columns=self.columns)
+        frame['href'] = member_url + '?b=' + frame['bar_num']
+        return frame
 
-    next_rows = _fetch_letter_list(letter, start_page + 1, n_total)
-    return letter_rows + next_rows
+    def work_units(self) -> List[str]:
+        """
+        The pages of the roster, which nodes list without the page
+        index, as it would have every node fetch the whole roster
+        """
+        return [f'roster-{page}' for page in self._roster_pages()]
 
+    def list_unit(self, unit) -> pd.DataFrame:
+        frame = self._roster_page(int(unit[len('roster-'):]))
+        # The rows the letters list
+        frame = frame[frame['name'].str[0].str.lower().isin(letters)]
+        return frame.assign(href=member_url + '?b=' + frame['bar_num'])
 
-def _oregon_list_by_letter(letter):
-    params = {'last': letter, 'cp': 1}
-    soup = safe_get_soup(search_url, params=params)
-    n_pages = _get_page_count(soup)
-    start_page = _find_letter_start_page(letter, 1, n_pages)
-    letter_list = _fetch_letter_list(letter, start_page, n_pages)
-    return letter_list
+    def list_attorneys(self):
+        self._build_roster_index()
+        return super(OregonListByLetters, self).list_attorneys()
 
+    def iter_frames(self) -> Iterator[pd.DataFrame]:
+        self._build_roster_index()
+        yield from super(OregonListByLetters, self).iter_frames()
 
-class OregonListByLetters(ListByLettersScraper):
-    def _list_by_letter_internal(self, letter) -> pd.DataFrame:
-        letter_list = _oregon_list_by_letter(letter)
-        frame = pd.DataFrame(letter_list,
-                             columns=['bar_num', 'name', 'city'])
-        frame['href'] = member_url + '?b=' + frame['bar_num']
-        return frame
+    def __init__(self, *args, **kwargs):
+        super(OregonListByLetters, self).__init__(*args, **kwargs)
+        self._index = None
 
 
-def attorney_details(page_url):
+def parse_attorney_details(page_url, content):
     fields = {'mstatus': 'status', 'madmitdate': 'admit_date',
               'mphone': 'phone', 'memail': 'email'}
-    soup = safe_get_soup(page_url)
-    table = soup.find('table', id='tbl_member')
-    trs = table.findAll('tr')
+    table = member_table_xpath(parse_html(content))[0]
+    trs = table.iterdescendants('tr')
 
     details = {}
     for tr in trs:
-        tds = tr.findAll('td')
+        tds = list(tr.iterdescendants('td'))
         if len(tds) < 2:
             continue
-        id_ = tds[1].attrs.get('id')
+        id_ = tds[1].get('id')
         if id_ is not None and id_ not in fields.keys():
             if id_ != 'mnum':
                 print(f'passing {id_}')
             continue
         elif id_ is not None and id_ in fields:
-            details[fields.get(tds[1].attrs['id'])] = tds[1].text.strip()
+            details[fields.get(id_)] = node_text(tds[1]).strip()
             if id_ == 'memail':
-                email_td = table.find('td', id='memail')
+                email_td = next(table.iterfind('.//td[@id="memail"]'), None)
                 if email_td is None:
                     continue
-                email_a = email_td.find('a')
+                email_a = next(email_td.iterdescendants('a'), None)
                 if email_a is None:
                     continue
-                href = email_a.attrs['href']
-                text = email_a.text
+                href = email_a.get('href')
+                text = node_text(email_a)
 
                 failed_message = f'check page url {page_url}'
                 try:
@@ -150,10 +193,15 @@ def attorney_details(page_url):
                 except AssertionError as aex:
                     print('AssertionError:', aex)
         else:
-            details[tds[0].text.strip()] = tds[1].text.strip()
+            details[node_text(tds[0]).strip()] = node_text(tds[1]).strip()
     return page_url, details
 
 
+def attorney_details(page_url):
+    content = safe_get_content(page_url)
+    return parse_attorney_details(page_url, content)
+
+
 class OregonAttorneyDetails(DetailsScraper):
     def _list_urls(self, attorneys: pd.DataFrame) -> List[str]:
         return attorneys['href'].tolist()
@@ -162,20 +210,30 @@ class OregonAttorneyDetails(DetailsScraper):
         details = attorney_details(page_url)
         return details
 
+    def _parse_page_details(self, page_url, content) -> Tuple[str, dict]:
+        return parse_attorney_details(page_url, content)
+
+
+def make_scraper(cache_path, **kwargs) -> AttorneysScraper:
+    """The Oregon scraper, kwargs are those of AttorneysScraper"""
+    return AttorneysScraper(cache_path=cache_path, name='oregon',
+                            list_scraper=OregonListByLetters,
+                            details_scraper=OregonAttorneyDetails,
+                            hosts=[host], **kwargs)
+
 
-def main(output, cache_path):
-    scraper = AttorneysScraper(cache_path=cache_path,
-                               name='oregon',
-                               list_scraper=OregonListByLetters,
-                               details_scraper=OregonAttorneyDetails,
-                               )
-    attorneys = scraper.scrape()
-    attorneys.to_csv(output)
+def main(output, cache_path, stream=False, prometheus=None, **kwargs):
+    """Scrapes into output, kwargs are those of AttorneysScraper"""
+    scraper = make_scraper(cache_path, **kwargs)
+    write_scraped(scraper, output, stream=stream, prometheus=prometheus)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('output')
-    parser.add_argument('cache')
+    parser.add_argument('output',
+                        help='csv file, parquet if it ends with .parquet, '
+                             'or json lines if it ends with .jsonl')
+    parser.add_argument('cache_path', metavar='cache')
+    add_scraper_arguments(parser)
     args = parser.parse_args()
-    main(args.output, args.cache)
+    main(**vars(args))
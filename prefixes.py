@@ -0,0 +1,110 @@
+import queue
+import sqlite3
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import multiprocessing.pool
+
+# Searches a prefix, returning its rows and whether its results overflowed
+PrefixSearch = Callable[[str], Tuple[List[dict], bool]]
+
+
+class PrefixIndex:
+    """
+    Result count, overflow flag and last-seen time of every searched
+    prefix, backed by SQLite. Later runs skip the prefixes known to
+    overflow and search their narrower prefixes straight away.
+    """
+
+    def overflows(self, prefix) -> bool:
+        """Whether prefix overflowed when last seen, within max_age"""
+        return prefix in self._overflowing
+
+    def record(self, prefix, count: int, overflow: bool):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO prefixes (prefix, count, overflow, seen_at) '
+            'VALUES (?, ?, ?, ?)', (prefix, count, int(overflow), time.time()))
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __init__(self, path, max_age: Optional[float] = None):
+        """Overflows seen more than max_age seconds ago are searched again"""
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS prefixes ('
+            'prefix TEXT PRIMARY KEY, count INTEGER NOT NULL, '
+            'overflow INTEGER NOT NULL, seen_at REAL NOT NULL)')
+        self._conn.commit()
+        since = 0.0 if max_age is None else time.time() - max_age
+        rows = self._conn.execute(
+            'SELECT prefix FROM prefixes WHERE overflow AND seen_at >= ?',
+            (since,))
+        self._overflowing = {prefix for prefix, in rows}
+
+
+def search_prefixes(search: PrefixSearch,
+                    expand: Callable[[str], List[str]],
+                    roots: Iterable[str],
+                    pool: Optional[multiprocessing.pool.Pool] = None,
+                    index: Optional[PrefixIndex] = None
+                    ) -> Iterator[Tuple[str, List[dict]]]:
+    """
+    Searches the root prefixes, replacing every prefix whose results
+    overflow by the prefixes `expand` returns, and yields (prefix, rows)
+    of the prefixes that did not overflow as they resolve. All pending
+    prefixes are searched concurrently on the pool, whatever their depth,
+    and a prefix is only searched once per call. Prefixes the index
+    knows to overflow are expanded without being searched, and every
+    search result is recorded in it.
+    """
+    seen = set()
+    results = queue.Queue()
+    pending = 0
+
+    def submit(prefix):
+        nonlocal pending
+        prefixes = [prefix]
+        while len(prefixes) > 0:
+            prefix = prefixes.pop()
+            if prefix in seen:
+                continue
+            seen.add(prefix)
+            if index is not None and index.overflows(prefix):
+                prefixes.extend(expand(prefix))
+                continue
+            pending += 1
+            if pool is None:
+                results.put((prefix, search(prefix), None))
+                continue
+            pool.apply_async(
+                search, (prefix,),
+                callback=lambda result, prefix=prefix: results.put(
+                    (prefix, result, None)),
+                error_callback=lambda error, prefix=prefix: results.put(
+                    (prefix, None, error)))
+
+    for root in roots:
+        submit(root)
+    while pending > 0:
+        prefix, result, error = results.get()
+        pending -= 1
+        if error is not None:
+            raise error
+        rows, overflow = result
+        if index is not None:
+            index.record(prefix, len(rows), overflow)
+        if overflow:
+            for child in expand(prefix):
+                submit(child)
+        else:
+            yield prefix, rows
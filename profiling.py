@@ -0,0 +1,180 @@
+"""
+Sampling profiler for whole runs. Every process samples the stacks of
+all its threads at a fixed interval, each tagged with the stage its
+thread is in, and flushes the counts to one file per pid. The merged
+profile is written in the folded format that flamegraph.pl, inferno and
+speedscope read, once for the run and once per stage. Sampling is off
+until `configure_profiling` is called.
+"""
+import collections
+import contextlib
+import glob
+import json
+import multiprocessing.util
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+# Seconds between two samples of the stacks
+interval = 0.01
+# Seconds between flushes of a process's samples to its file
+flush_interval = 5.0
+
+_dir: Optional[str] = None
+_lock = threading.Lock()
+_samples: Dict[str, int] = collections.Counter()
+# Stages entered by each thread, innermost last
+_thread_stages: Dict[int, List[str]] = {}
+# Stage of the threads that entered none, the main thread's stage
+_default_stage = 'other'
+
+
+def _frame_name(code) -> str:
+    return (f'{code.co_name} '
+            f'({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+
+
+def _folded_stack(stage, frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    names.append(stage)
+    return ';'.join(reversed(names))
+
+
+def _sample_forever():
+    own = threading.get_ident()
+    flushed_at = time.monotonic()
+    while True:
+        time.sleep(interval)
+        frames = sys._current_frames()
+        with _lock:
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                try:
+                    stage = _thread_stages[ident][-1]
+                except (KeyError, IndexError):
+                    stage = _default_stage
+                _samples[_folded_stack(stage, frame)] += 1
+        del frames
+        if time.monotonic() - flushed_at >= flush_interval:
+            flush()
+            flushed_at = time.monotonic()
+
+
+def _start_sampler():
+    threading.Thread(target=_sample_forever, name='profiling-sampler',
+                     daemon=True).start()
+
+
+def _after_fork():
+    # The sampler thread does not survive a fork, see `init_worker`
+    global _lock, _samples
+    _lock = threading.Lock()
+    _samples = collections.Counter()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Tags the samples of the calling thread with stage name"""
+    global _default_stage
+    if _dir is None:
+        yield
+        return
+    ident = threading.get_ident()
+    is_main = threading.current_thread() is threading.main_thread()
+    previous = _default_stage
+    _thread_stages.setdefault(ident, []).append(name)
+    if is_main:
+        _default_stage = name
+    try:
+        yield
+    finally:
+        _thread_stages[ident].pop()
+        if is_main:
+            _default_stage = previous
+
+
+def flush():
+    """Writes the samples of this process to its file"""
+    if _dir is None:
+        return
+    with _lock:
+        state = json.dumps(_samples)
+    path = os.path.join(_dir, f'profile-{os.getpid()}.json')
+    with open(f'{path}.tmp', 'w') as profile_file:
+        profile_file.write(state)
+    os.replace(f'{path}.tmp', path)
+
+
+def init_worker():
+    """Pool initializer sampling the worker and flushing it when it exits"""
+    if _dir is not None:
+        _start_sampler()
+        multiprocessing.util.Finalize(None, flush, exitpriority=0)
+
+
+def configure_profiling(profile_dir):
+    """
+    Starts sampling this process and the pool workers started later,
+    into profile_dir
+    """
+    global _dir
+    if _dir is not None:
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(profile_dir, 'profile-*.json')):
+        os.remove(path)
+    _dir = profile_dir
+    _start_sampler()
+
+
+def merged_samples() -> Dict[str, int]:
+    """Sums the samples flushed by every process of the run"""
+    flush()
+    merged = collections.Counter()
+    for path in glob.glob(os.path.join(_dir, 'profile-*.json')):
+        try:
+            with open(path) as profile_file:
+                merged.update(json.load(profile_file))
+        except (OSError, ValueError):
+            continue
+    return merged
+
+
+def write_profiles(top: int = 5, logfile=None):
+    """
+    Writes profile.folded, rooted at the stages, and one
+    profile.<stage>.folded per stage into the profile directory, and
+    prints the functions most often on top of the stack in each stage
+    """
+    if _dir is None:
+        return
+    merged = merged_samples()
+    by_stage = collections.defaultdict(dict)
+    for stack, count in merged.items():
+        stage_name, _, frames = stack.partition(';')
+        by_stage[stage_name][frames] = count
+    with open(os.path.join(_dir, 'profile.folded'), 'w') as folded:
+        for stack, count in sorted(merged.items()):
+            folded.write(f'{stack} {count}\n')
+    for stage_name, stacks in sorted(by_stage.items()):
+        path = os.path.join(_dir, f'profile.{stage_name}.folded')
+        with open(path, 'w') as folded:
+            for stack, count in sorted(stacks.items()):
+                folded.write(f'{stack} {count}\n')
+        leaves = collections.Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rpartition(';')[2]] += count
+        total = sum(leaves.values())
+        print(f'{stage_name}: {total * interval:.1f} thread seconds',
+              file=logfile)
+        for leaf, count in leaves.most_common(top):
+            print(f'  {100 * count / total:5.1f}% {leaf}', file=logfile)
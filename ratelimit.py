@@ -0,0 +1,110 @@
+import asyncio
+import fcntl
+import json
+import os
+import time
+import urllib.parse
+from typing import Dict, Optional, Tuple, Union
+
+
+class RateLimiter:
+    """
+    Token bucket for one host, refilled at `rate` tokens per second and
+    holding at most `burst` tokens. Its state lives in a small file
+    guarded by flock, so every worker of a run shares the same bucket
+    whether it is a forked process, a thread or an asyncio task.
+    """
+
+    def reserve(self) -> float:
+        """Takes a token and returns how long to wait before using it"""
+        with open(self._path, 'r+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state = json.load(state_file)
+            now = time.time()
+            # The bucket is tracked as the time at which it would be
+            # empty again (GCRA), which equals a token bucket refill
+            empty_at = max(state['empty_at'], now)
+            wait = max(0.0, empty_at - now - (self.burst - 1) / self.rate)
+            state['empty_at'] = empty_at + 1 / self.rate
+            state['requests'] += 1
+            state['waited'] += wait
+            state_file.seek(0)
+            state_file.truncate()
+            json.dump(state, state_file)
+        return wait
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+    async def acquire_async(self):
+        # reserve locks and rewrites the file, kept off the event loop
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(await loop.run_in_executor(None, self.reserve))
+
+    def stats(self) -> dict:
+        """Returns the number of requests and the seconds they waited"""
+        with open(self._path) as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_SH)
+            state = json.load(state_file)
+        return {'requests': state['requests'], 'waited': state['waited']}
+
+    def reset(self):
+        with open(self._path, 'w') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            json.dump({'empty_at': 0.0, 'requests': 0, 'waited': 0.0},
+                      state_file)
+
+    def __init__(self, path, rate: float, burst: int = 1):
+        self._path = path
+        self.rate = rate
+        self.burst = burst
+        if not os.path.exists(path):
+            self.reset()
+
+
+# Either requests per second or a (requests per second, burst) tuple
+RateLimit = Union[float, Tuple[float, int]]
+
+_limiters: Dict[str, RateLimiter] = {}
+
+
+def parse_rate_limit(value) -> RateLimit:
+    """Parses 'RATE' or 'RATE:BURST', as given on the command line"""
+    rate, _, burst = value.partition(':')
+    return (float(rate), int(burst)) if burst else float(rate)
+
+
+def configure_rate_limits(rate_limits: Dict[str, RateLimit], state_dir):
+    """
+    Sets up the per-host limiters of a run in the current process.
+    Must be called before the worker pools are started, which inherit them.
+    """
+    if not os.path.exists(state_dir):
+        os.mkdir(state_dir)
+    for host, limit in rate_limits.items():
+        rate, burst = limit if isinstance(limit, tuple) else (limit, 1)
+        limiter = RateLimiter(os.path.join(state_dir, f'{host}.json'),
+                              rate=rate, burst=burst)
+        limiter.reset()
+        _limiters[host] = limiter
+
+
+def get_rate_limiter(url) -> Optional[RateLimiter]:
+    return _limiters.get(urllib.parse.urlsplit(url).netloc)
+
+
+def throttle(url):
+    """Blocks until a request to the host of url is allowed"""
+    limiter = get_rate_limiter(url)
+    if limiter is not None:
+        limiter.acquire()
+
+
+async def throttle_async(url):
+    limiter = get_rate_limiter(url)
+    if limiter is not None:
+        await limiter.acquire_async()
+
+
+def rate_limit_stats() -> Dict[str, dict]:
+    return {host: limiter.stats() for host, limiter in _limiters.items()}
@@ -0,0 +1,139 @@
+import email.utils
+import random
+import threading
+import time
+from typing import Optional
+
+
+class FetchFailure:
+    """Typed result for a url that could not be fetched within the policy"""
+
+    def __repr__(self):
+        return (f'FetchFailure(url={self.url!r}, error={self.error!r}, '
+                f'attempts={self.attempts})')
+
+    def __init__(self, url, error: str, attempts: int):
+        self.url = url
+        self.error = error
+        self.attempts = attempts
+
+
+class FetchError(Exception):
+    """Raised once a fetch has used up all the attempts of its policy"""
+
+    def __init__(self, failure: FetchFailure):
+        super(FetchError, self).__init__(
+            f'failed to fetch {failure.url} after {failure.attempts} '
+            f'attempts: {failure.error}')
+        self.failure = failure
+
+    def __reduce__(self):
+        # args only hold the message, rebuild from the failure so that
+        # errors of pool workers reach the parent
+        return FetchError, (self.failure,)
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """Parses a Retry-After header, given in seconds or as an HTTP date"""
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker. After `threshold` consecutive failures the
+    host is left alone for `reset_timeout` seconds, then the breaker is
+    half open: one probe request is let through while the others keep
+    waiting, and its outcome either closes the breaker or opens it again.
+    A probe that reports nothing within `reset_timeout` is given up on.
+    """
+
+    def wait_time(self, host) -> float:
+        """
+        Returns how long a request to host should wait before asking
+        again, or 0 once it may be sent, possibly as the probe
+        """
+        with self._lock:
+            opened_at = self._opened_at.get(host)
+            if opened_at is None:
+                return 0.0
+            now = time.monotonic()
+            if now < opened_at + self.reset_timeout:
+                return opened_at + self.reset_timeout - now
+            probe_at = self._probe_at.get(host)
+            if probe_at is not None and now < probe_at + self.reset_timeout:
+                return min(self.probe_poll_interval,
+                           probe_at + self.reset_timeout - now)
+            self._probe_at[host] = now
+            return 0.0
+
+    def record_success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+            self._opened_at.pop(host, None)
+            self._probe_at.pop(host, None)
+
+    def record_failure(self, host):
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            if failures >= self.threshold:
+                self._opened_at[host] = time.monotonic()
+                self._probe_at.pop(host, None)
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0,
+                 probe_poll_interval: float = 0.1):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        # Seconds between checks of the requests waiting on a probe
+        self.probe_poll_interval = probe_poll_interval
+        self._failures = {}
+        self._opened_at = {}
+        self._probe_at = {}
+        self._lock = threading.Lock()
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, capped at `max_delay` and
+    `max_attempts`. A Retry-After sent by the server takes precedence
+    over the computed backoff.
+    """
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Returns how long to sleep after the given failed attempt"""
+        if retry_after is not None:
+            return retry_after
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, backoff)
+
+    def __init__(self, max_attempts: int = 6, base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 retry_statuses=(429, 500, 502, 503, 504),
+                 breaker: Optional[CircuitBreaker] = None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = frozenset(retry_statuses)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+
+_policy = RetryPolicy()
+
+
+def get_retry_policy() -> RetryPolicy:
+    return _policy
+
+
+def set_retry_policy(policy: RetryPolicy):
+    """Sets the policy of the current process, inherited by forked workers"""
+    global _policy
+    _policy = policy
@@ -0,0 +1,421 @@
+"""
+Runs several states at once on one machine within a global budget. The
+Washington, Oregon and California scrapers share one pool of worker
+processes: each state runs on its own thread, and every pool it opens is
+a view of the shared pool that waits for a free slot of the pool, a free
+slot of the state's host and room in the memory budget before handing
+over a task. New York searches on its own browser processes, which count
+against the same budget. Each state writes its own output.
+"""
+import argparse
+import contextlib
+import functools
+import importlib
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import traceback
+import urllib.parse
+from typing import Dict, List, Optional, Tuple
+
+from scrapers.attorneys.base import open_pool, process_rss_mb, use_pool
+from scrapers.attorneys.concurrency import configure_adaptive_limits
+from scrapers.attorneys.frames import FrameWriter, write_frame
+from scrapers.attorneys.prefixes import PrefixIndex, search_prefixes
+from scrapers.attorneys.ratelimit import (
+    configure_rate_limits, parse_rate_limit)
+
+states = ['washington', 'oregon', 'california', 'new_york']
+
+
+class Budget:
+    """
+    Memory budget and per-host limits shared by the pools of a run.
+    Tasks wait while the run uses more than max_memory MB, unless none
+    is running, and while their host has host_limits[host] or
+    default_host_limit tasks running.
+    """
+
+    def host_slots(self, host) -> Optional[threading.Semaphore]:
+        with self._lock:
+            if host not in self._host_slots:
+                limit = self._host_limits.get(host, self._default_host_limit)
+                self._host_slots[host] = (
+                    threading.Semaphore(limit) if limit is not None else None)
+            return self._host_slots[host]
+
+    def rss_mb(self) -> float:
+        """Memory of this process and its descendants, measured once a second"""
+        now = time.monotonic()
+        if now - self._measured_at >= 1.0:
+            self._rss_mb, self._measured_at = process_rss_mb(os.getpid()), now
+        return self._rss_mb
+
+    def wait_for_memory(self):
+        with self._running:
+            while (self.max_memory is not None and self._tasks > 0
+                   and self.rss_mb() > self.max_memory):
+                self._running.wait(timeout=1.0)
+            self._tasks += 1
+
+    def task_done(self):
+        with self._running:
+            self._tasks -= 1
+            self._running.notify()
+
+    def __init__(self, max_memory: Optional[float] = None,
+                 host_limits: Optional[Dict[str, int]] = None,
+                 default_host_limit: Optional[int] = None):
+        self.max_memory = max_memory
+        self._host_limits = host_limits or {}
+        self._default_host_limit = default_host_limit
+        self._host_slots = {}
+        self._lock = threading.Lock()
+        self._running = threading.Condition()
+        self._tasks = 0
+        self._rss_mb, self._measured_at = 0.0, float('-inf')
+
+
+class SharedPool:
+    """
+    A pool whose size bounds the tasks handed to it by all the threads
+    of a run, so that no state queues its whole work ahead of the others
+    """
+
+    def view(self, host) -> 'PoolView':
+        return PoolView(self, host)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __init__(self, pool: mp.pool.Pool, size: int, budget: Budget):
+        self._pool = pool
+        self._slots = threading.Semaphore(size)
+        self.budget = budget
+
+
+class PoolView:
+    """
+    The part of a `SharedPool` a state uses for the requests to its host,
+    with the interface of the `mp.pool.Pool` methods the scrapers call.
+    Leaving its block leaves the shared pool open.
+    """
+
+    def apply_async(self, func, args=(), kwds=None, callback=None,
+                    error_callback=None):
+        if self._host_slots is not None:
+            self._host_slots.acquire()
+        self._shared._slots.acquire()
+        self._shared.budget.wait_for_memory()
+
+        def release():
+            self._shared.budget.task_done()
+            self._shared._slots.release()
+            if self._host_slots is not None:
+                self._host_slots.release()
+
+        def on_result(result):
+            release()
+            if callback is not None:
+                callback(result)
+
+        def on_error(error):
+            release()
+            if error_callback is not None:
+                error_callback(error)
+
+        return self._shared._pool.apply_async(
+            func, args, kwds or {}, callback=on_result, error_callback=on_error)
+
+    @contextlib.contextmanager
+    def request_slot(self):
+        """
+        Holds a slot of the host and of the memory budget while the
+        calling thread makes a request itself, as the fetch threads of
+        the pipelined details engine do
+        """
+        if self._host_slots is not None:
+            self._host_slots.acquire()
+        self._shared.budget.wait_for_memory()
+        try:
+            yield
+        finally:
+            self._shared.budget.task_done()
+            if self._host_slots is not None:
+                self._host_slots.release()
+
+    def parse_view(self) -> 'PoolView':
+        """A view of the same pool for tasks that make no request"""
+        return PoolView(self._shared, None)
+
+    def _imap(self, func, iterable, ordered: bool):
+        # Tasks are submitted from a thread as slots free up, while the
+        # results are yielded as they arrive, or in order when ordered
+        results = queue.Queue()
+        stopped = threading.Event()
+        submitted = []
+
+        def feed():
+            count = 0
+            try:
+                for item in iterable:
+                    if stopped.is_set():
+                        break
+                    self.apply_async(
+                        func, (item,),
+                        callback=lambda result, i=count: results.put(
+                            (i, result, None)),
+                        error_callback=lambda error, i=count: results.put(
+                            (i, None, error)))
+                    count += 1
+            except BaseException as ex:
+                results.put((None, None, ex))
+            submitted.append(count)
+            results.put(None)
+
+        threading.Thread(target=feed, daemon=True).start()
+        buffered, received, next_index = {}, 0, 0
+        try:
+            while len(submitted) == 0 or received < submitted[0]:
+                item = results.get()
+                if item is None:
+                    continue
+                index, result, error = item
+                if error is not None:
+                    raise error
+                received += 1
+                if not ordered:
+                    yield result
+                    continue
+                buffered[index] = result
+                while next_index in buffered:
+                    yield buffered.pop(next_index)
+                    next_index += 1
+        finally:
+            stopped.set()
+
+    def imap_unordered(self, func, iterable):
+        return self._imap(func, iterable, ordered=False)
+
+    def imap(self, func, iterable):
+        return self._imap(func, iterable, ordered=True)
+
+    def map(self, func, iterable) -> list:
+        return list(self.imap(func, iterable))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __init__(self, shared: SharedPool, host):
+        self._shared = shared
+        self._host_slots = (shared.budget.host_slots(host)
+                            if host is not None else None)
+
+
+def plan_processes(processes: int, browsers: int,
+                   max_memory: Optional[float] = None,
+                   worker_mb: float = 150.0,
+                   browser_mb: float = 600.0) -> Tuple[int, int]:
+    """
+    Splits the process budget into shared workers and browsers, giving
+    browsers at most half of it, and shrinks both until their estimated
+    memory fits max_memory MB
+    """
+    if browsers > 0:
+        browsers = max(1, min(browsers, processes // 2))
+    workers = max(1, processes - browsers)
+
+    def memory():
+        return workers * worker_mb + browsers * browser_mb
+
+    if max_memory is not None:
+        while browsers > 1 and memory() > max_memory:
+            browsers -= 1
+        while workers > 1 and memory() > max_memory:
+            workers -= 1
+    return workers, browsers
+
+
+def _output_path(output_dir, state, output_format) -> str:
+    return os.path.join(output_dir, f'{state}.{output_format}')
+
+
+def _run_state(state, scraper, pool: PoolView, output):
+    with use_pool(pool):
+        attorneys = scraper.scrape()
+    write_frame(attorneys, output)
+    print(f'{state}: wrote {len(attorneys)} attorneys to {output}')
+
+
+def _run_new_york(new_york, cache, pool: PoolView, output, detail_threads=None,
+                  max_results=100):
+    search = functools.partial(new_york.search_term, cache=cache,
+                               detail_threads=detail_threads,
+                               max_results=max_results)
+    index_path = os.path.join(cache, 'terms.sqlite')
+    with PrefixIndex(index_path) as index, FrameWriter(
+            output, key=new_york.registration_label) as writer:
+        new_york._write_attorneys(search_prefixes(
+            search, new_york.expand_term, new_york.root_terms(), pool=pool,
+            index=index), writer)
+    print(f'new_york: wrote {output}')
+
+
+def run(run_states: List[str], cache, output_dir, processes=None,
+        browsers: int = 0, max_memory: Optional[float] = None,
+        default_host_limit: Optional[int] = None,
+        host_limits: Optional[Dict[str, int]] = None,
+        output_format='csv', worker_mb: float = 150.0,
+        browser_mb: float = 600.0, browser_terms: int = 200,
+        detail_threads: Optional[int] = None, max_results: int = 100,
+        **kwargs) -> bool:
+    """
+    Scrapes run_states concurrently within the budget of processes
+    processes and max_memory MB, kwargs go to the state scrapers.
+    New York needs browsers, the number of browser processes wanted.
+    Returns whether every state succeeded.
+    """
+    processes = processes or mp.cpu_count()
+    if 'new_york' in run_states:
+        browsers = browsers or max(1, processes // 4)
+    else:
+        browsers = 0
+    workers, browsers = plan_processes(processes, browsers, max_memory,
+                                       worker_mb, browser_mb)
+    print(f'{workers} shared workers, {browsers} browsers')
+    os.makedirs(output_dir, exist_ok=True)
+    if not os.path.exists(cache):
+        os.mkdir(cache)
+    budget = Budget(max_memory, host_limits, default_host_limit)
+
+    # Scrapers configure their rate limits, which the pools must inherit
+    jobs = []
+    for state in run_states:
+        if state == 'new_york':
+            continue
+        module = importlib.import_module(f'scrapers.attorneys.{state}')
+        scraper = module.make_scraper(cache, processes=workers, **kwargs)
+        jobs.append((state, scraper, module.host))
+    new_york = None
+    if 'new_york' in run_states:
+        new_york = importlib.import_module('scrapers.attorneys.new_york')
+        ny_cache = os.path.join(cache, 'new_york')
+        if not os.path.exists(ny_cache):
+            os.mkdir(ny_cache)
+        configure_rate_limits(new_york.rate_limits,
+                              os.path.join(ny_cache, 'ratelimit'))
+        if kwargs.get('adaptive') and detail_threads is not None:
+            configure_adaptive_limits(new_york.rate_limits,
+                                      os.path.join(ny_cache, 'concurrency'),
+                                      max_limit=browsers * detail_threads)
+
+    shared = SharedPool(open_pool(workers), workers, budget)
+    browser_pool = None
+    if new_york is not None:
+        browser_pool = SharedPool(
+            mp.Pool(browsers, initializer=new_york.init_browser,
+                    initargs=(browser_terms, browser_mb)),
+            browsers, budget)
+
+    failed = []
+
+    def guarded(state, target, *args, **target_kwargs):
+        try:
+            target(*args, **target_kwargs)
+        except Exception:
+            traceback.print_exc()
+            failed.append(state)
+
+    threads = [threading.Thread(
+        target=guarded, args=(state, _run_state, state, scraper,
+                              shared.view(host),
+                              _output_path(output_dir, state, output_format)))
+        for state, scraper, host in jobs]
+    if new_york is not None:
+        threads.append(threading.Thread(
+            target=guarded,
+            args=('new_york', _run_new_york, new_york, ny_cache,
+                  browser_pool.view(new_york.host),
+                  _output_path(output_dir, 'new_york', output_format)),
+            kwargs={'detail_threads': detail_threads,
+                    'max_results': max_results}))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    shared.close()
+    if browser_pool is not None:
+        # Lets the workers exit, so that they quit their browsers
+        browser_pool.close()
+
+    if len(failed) > 0:
+        print(f'failed states: {", ".join(failed)}')
+    return len(failed) == 0
+
+
+def _host_limit(spec) -> Tuple[str, int]:
+    host, _, limit = spec.partition('=')
+    if '://' in host:
+        host = urllib.parse.urlsplit(host).netloc
+    return host, int(limit)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cache')
+    parser.add_argument('output_dir',
+                        help='directory receiving one <state>.<format> '
+                             'output per state')
+    parser.add_argument('states', nargs='+', choices=states)
+    parser.add_argument('--format', default='csv',
+                        choices=['csv', 'parquet', 'jsonl'])
+    parser.add_argument('--processes', type=int, default=None,
+                        help='processes shared by all states, browsers '
+                             'included, defaults to the cpu count')
+    parser.add_argument('--max-memory', type=float, default=None,
+                        help='MB of memory for the whole run, tasks wait '
+                             'while it uses more')
+    parser.add_argument('--per-host', type=int, default=None,
+                        help='tasks running at once against any one host')
+    parser.add_argument('--host-limit', type=_host_limit, action='append',
+                        default=[], metavar='HOST=N',
+                        help='tasks running at once against HOST, '
+                             'overriding --per-host')
+    parser.add_argument('--browsers', type=int, default=0,
+                        help='browsers searching New York at once, defaults '
+                             'to a quarter of the processes')
+    parser.add_argument('--browser-mb', type=float, default=600.0,
+                        help='memory of a browser, which is restarted past it')
+    parser.add_argument('--worker-mb', type=float, default=150.0,
+                        help='estimated memory of a shared worker')
+    parser.add_argument('--detail-threads', type=int, default=None,
+                        help='fetch New York detail pages over HTTP on this '
+                             'many threads per browser')
+    parser.add_argument('--http-cache', default=None,
+                        help='keep the raw responses in this directory')
+    parser.add_argument('--fetch-threads', type=int, default=None,
+                        help="fetch each state's details on this many "
+                             'threads, leaving the shared workers to parse')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='adapt the requests in flight to each host to '
+                             'its latency and errors, up to the workers')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, default=None,
+                        metavar='RATE[:BURST]',
+                        help='requests per second to each host of '
+                             'Washington, Oregon and California')
+    args = parser.parse_args()
+    ok = run(args.states, args.cache, args.output_dir,
+             processes=args.processes, browsers=args.browsers,
+             max_memory=args.max_memory, default_host_limit=args.per_host,
+             host_limits=dict(args.host_limit), output_format=args.format,
+             worker_mb=args.worker_mb, browser_mb=args.browser_mb,
+             detail_threads=args.detail_threads, http_cache=args.http_cache,
+             adaptive=args.adaptive, fetch_threads=args.fetch_threads,
+             rate_limit=args.rate_limit)
+    raise SystemExit(0 if ok else 1)
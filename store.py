@@ -0,0 +1,110 @@
+import json
+import sqlite3
+import time
+from typing import Iterable, Set, Tuple
+
+import pandas as pd
+
+from scrapers.attorneys.retry import FetchFailure
+
+
+class DetailsStore:
+    """
+    Durable per-url store of attorney details, backed by SQLite.
+    Every page is recorded as soon as its details arrive, so an
+    interrupted run resumes from the urls that are not done yet.
+    """
+
+    def done_urls(self) -> Set[str]:
+        """Returns the urls whose details are already stored"""
+        rows = self._conn.execute('SELECT page_url FROM details')
+        return {page_url for page_url, in rows}
+
+    def put(self, page_url, details: dict):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO details (page_url, details, fetched_at) '
+            'VALUES (?, ?, ?)', (page_url, json.dumps(details), time.time()))
+        self._conn.execute('DELETE FROM failures WHERE page_url = ?',
+                           (page_url,))
+        self._conn.commit()
+
+    def put_many(self, items: Iterable[Tuple[str, dict]]):
+        """Stores many (page_url, details) at once, in one transaction"""
+        now = time.time()
+        items = [(page_url, json.dumps(details), now)
+                 for page_url, details in items]
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO details (page_url, details, fetched_at) '
+            'VALUES (?, ?, ?)', items)
+        self._conn.executemany('DELETE FROM failures WHERE page_url = ?',
+                               [(page_url,) for page_url, _, _ in items])
+        self._conn.commit()
+
+    def discard(self, page_urls: Iterable[str]):
+        """Forgets the details of page_urls, so they are fetched again"""
+        self._conn.executemany('DELETE FROM details WHERE page_url = ?',
+                               [(page_url,) for page_url in page_urls])
+        self._conn.commit()
+
+    def discard_older_than(self, timestamp: float) -> int:
+        """Forgets the details fetched before timestamp, returns their count"""
+        cursor = self._conn.execute(
+            'DELETE FROM details WHERE fetched_at < ?', (timestamp,))
+        self._conn.commit()
+        return cursor.rowcount
+
+    def put_failure(self, page_url, failure: FetchFailure):
+        """Records a page that could not be fetched, to be retried later"""
+        self._conn.execute(
+            'INSERT OR REPLACE INTO failures '
+            '(page_url, error, attempts, failed_at) VALUES (?, ?, ?, ?)',
+            (page_url, failure.error, failure.attempts, time.time()))
+        self._conn.commit()
+
+    def failed_urls(self) -> Set[str]:
+        """Returns the urls that failed and were not stored since"""
+        rows = self._conn.execute('SELECT page_url FROM failures')
+        return {page_url for page_url, in rows}
+
+    def frame(self, page_urls: Iterable[str]) -> pd.DataFrame:
+        """Returns the stored details of page_urls, indexed by url"""
+        page_urls = list(dict.fromkeys(page_urls))
+        page_list, details_list = [], []
+        for start in range(0, len(page_urls), self._batch_size):
+            batch = page_urls[start:start + self._batch_size]
+            rows = self._conn.execute(
+                'SELECT page_url, details FROM details WHERE page_url IN '
+                f'({", ".join("?" * len(batch))})', batch)
+            for page_url, details in rows:
+                page_list.append(page_url)
+                details_list.append(json.loads(details))
+        return pd.DataFrame(details_list, index=page_list)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __init__(self, path, batch_size: int = 500, mmap_size: int = 2 ** 30):
+        self._path = path
+        # Urls per query when reading frames, below SQLite's variable limit
+        self._batch_size = batch_size
+        self._conn = sqlite3.connect(path)
+        # WAL keeps the per-page commits cheap
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        # Reads go through a memory map instead of copies into the cache
+        self._conn.execute(f'PRAGMA mmap_size={mmap_size}')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS details ('
+            'page_url TEXT PRIMARY KEY, details TEXT NOT NULL, '
+            'fetched_at REAL NOT NULL)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS failures ('
+            'page_url TEXT PRIMARY KEY, error TEXT NOT NULL, '
+            'attempts INTEGER NOT NULL, failed_at REAL NOT NULL)')
+        self._conn.commit()
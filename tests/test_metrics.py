@@ -0,0 +1,28 @@
+import threading
+
+from scrapers.attorneys import metrics
+
+
+def test_concurrent_flushes(tmp_path, monkeypatch):
+    # Every record flushes, from threads sharing the process's file
+    monkeypatch.setattr(metrics, 'flush_interval', 0)
+    # Restored once done, so that recording stops again
+    monkeypatch.setattr(metrics, '_dir', None)
+    metrics.configure_metrics(str(tmp_path))
+    errors = []
+
+    def record():
+        try:
+            for _ in range(200):
+                metrics.inc('test_total')
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    metrics.flush()
+    assert errors == []
+    assert metrics.snapshot()['counters']['test_total'] == 1600
@@ -0,0 +1,32 @@
+import pickle
+
+import pytest
+
+from scrapers.attorneys.base import open_pool, safe_get_content
+from scrapers.attorneys.retry import (
+    FetchError, FetchFailure, RetryPolicy, get_retry_policy, set_retry_policy)
+
+
+def test_fetch_error_pickles():
+    error = FetchError(FetchFailure('http://example.com/a', 'HTTP 503', 3))
+    restored = pickle.loads(pickle.dumps(error))
+    assert str(restored) == str(error)
+    assert restored.failure.url == 'http://example.com/a'
+    assert restored.failure.attempts == 3
+
+
+@pytest.fixture
+def no_retries():
+    policy = get_retry_policy()
+    set_retry_policy(RetryPolicy(max_attempts=1, base_delay=0.0))
+    yield
+    set_retry_policy(policy)
+
+
+def test_pool_raises_fetch_error(no_retries):
+    # Nothing listens on port 1, every fetch fails
+    url = 'http://127.0.0.1:1/'
+    with pytest.raises(FetchError) as raised:
+        with open_pool(2) as pool:
+            pool.apply_async(safe_get_content, (url,)).get(timeout=30)
+    assert raised.value.failure.url == url
@@ -9,85 +9,85 @@ Created on Sat Aug 27 17:17:39 2022
 import pandas as pd
 import argparse
 from typing import List, Tuple
-import numpy as np
 
-from base import (
-    safe_get_soup, AttorneysScraper, ListByLettersScraper, DetailsScraper)
+import lxml.etree
+
+from scrapers.attorneys.base import (
+    safe_get_content, AttorneysScraper, ListByPagesScraper,
+    DetailsScraper, add_scraper_arguments, write_scraped)
+from scrapers.attorneys.extract import (
+    FieldsExtractor, RowsExtractor, css_class, node_text, parse_html)
 
 search_tpl = 'https://www.mywsba.org/personifyebusiness/LegalDirectory.aspx?ShowSearchResults=TRUE&FirstName={letter}&Page={page}'
 member_url = 'https://www.mywsba.org/personifyebusiness/LegalDirectory/LegalProfile.aspx?Usr_ID='
-
-def _get_page_count(soup): 
-    pages = soup.find('span',id='dnn_ctr2972_DNNWebControlContainer_ctl00_lblRowCount') #actively removing ALL safeties here
-    total = [int(s) for s in pages.text.split() if s.isdigit()][0]
+# Host of the bar site, rate limited only when given a rate_limit
+host = 'www.mywsba.org'
+
+header = ['bar_num', 'first_name', 'last_name', 'city', 'status', 'phone']
+row_count_xpath = lxml.etree.XPath(
+    '//span[@id="dnn_ctr2972_DNNWebControlContainer_ctl00_lblRowCount"]')
+rows_extractor = RowsExtractor(
+    '//table[@id="dnn_ctr2972_DNNWebControlContainer_ctl00_dg"]'
+    f'//tr[{css_class("grid-row")}]', header=header)
+details_extractor = FieldsExtractor(
+    {'status': './/span[@id="dnn_ctr2977_DNNWebControlContainer_ctl00_lblStatus"]',
+     'admit_date': './/span[@id="dnn_ctr2977_DNNWebControlContainer_ctl00_lblWaAdmitDate"]',
+     'phone': './/span[@id="dnn_ctr2977_DNNWebControlContainer_ctl00_lblPhone"]',
+     'email': './/span[@id="dnn_ctr2977_DNNWebControlContainer_ctl00_lblEmail"]'},
+    scope='//*[@id="dnn_ctr2977_DNNWebControlContainer_ctl00_ContainerPanel"]')
+
+
+def _get_page_count(root):
+    pages = row_count_xpath(root)[0]
+    total = [int(s) for s in node_text(pages).split() if s.isdigit()][0]
     page_count = total//20
     return page_count
 
 
-def parse_table(table):
-    page = []
-    header=['bar_num', 'first_name','last_name', 'city','status','phone']
-    trs = table.findAll('tr',{'class':'grid-row'})
-    for row in trs:
-        row_dict = {}
-        for i, cell in enumerate(row.findAll('td')):
-            row_dict[header[i]] = cell.text.strip()
-        page.append(row_dict)
-    return page
-
-
-def _fetch_letter_list(letter, n_total) -> list:
-    results = []
-    for i in np.arange(0,n_total+1,1):
-        soup = safe_get_soup(search_tpl.format(letter=letter,page=i))
-        table = soup.find('table', id='dnn_ctr2972_DNNWebControlContainer_ctl00_dg')
-        page = parse_table(table)
-        results.extend(page)
-    return results
-
-    
-def _washington_list_by_letter(letter):
-    print(letter + " in washington list by letter function")
-    soup = safe_get_soup(search_tpl.format(letter=letter,page=1))
-    n_pages = _get_page_count(soup)
-    letter_list = _fetch_letter_list(letter, n_pages)
-    return letter_list
-
-
-class WashingtonListByLetters(ListByLettersScraper): 
-    def _list_by_letter_internal(self, letter) -> pd.DataFrame:
-        letter_list = _washington_list_by_letter(letter)
-        frame = pd.DataFrame(letter_list,
-                             columns=['bar_num', 'first_name','last_name', 'city','status','phone']) #refer back here
+def parse_table(root):
+    return rows_extractor(root)
+
+
+def _fetch_page(letter, page):
+    return parse_html(safe_get_content(search_tpl.format(letter=letter, page=page)))
+
+
+class WashingtonListByLetters(ListByPagesScraper):
+    key_column = 'bar_num'
+    watch_columns = ['status', 'city']
+
+    @staticmethod
+    def _page_frame(root) -> pd.DataFrame:
+        frame = pd.DataFrame(parse_table(root), columns=header)
         frame['href'] = member_url + frame['bar_num'].str.zfill(12)
         return frame
 
-# not even sure it's grabbing anything
+    def _letter_pages(self, letter):
+        root = _fetch_page(letter, 1)
+        # The count comes with the first page, which need not be fetched again
+        self._cache_dump_term_frame(f'{letter}-1', self._page_frame(root))
+        return list(range(0, _get_page_count(root) + 1))
 
-def attorney_details(page_url): #given a URL
-    soup = safe_get_soup(page_url) #get the soup page url
-    
-    member_details = soup.find(id='dnn_ctr2977_DNNWebControlContainer_ctl00_ContainerPanel')
-    
-    status = member_details.find('span',id='dnn_ctr2977_DNNWebControlContainer_ctl00_lblStatus')
-    admit_date = member_details.find('span',id='dnn_ctr2977_DNNWebControlContainer_ctl00_lblWaAdmitDate')
-    phone = member_details.find('span',id='dnn_ctr2977_DNNWebControlContainer_ctl00_lblPhone')
-    email = member_details.find('span',id='dnn_ctr2977_DNNWebControlContainer_ctl00_lblEmail')
-    
-    details = {}      
-    
-    details['status'] = status.text.strip()
-    details['admit_date'] = admit_date.text.strip()
-    details['phone'] = phone.text.strip()
-    details['email'] = email.text.strip()
-    
+    def _list_page_internal(self, letter, page) -> pd.DataFrame:
+        return self._page_frame(_fetch_page(letter, page))
+
+
+def parse_attorney_details(page_url, content):
+    details = details_extractor(parse_html(content))
     return page_url, details
 
+
+def attorney_details(page_url): #given a URL
+    content = safe_get_content(page_url)
+    return parse_attorney_details(page_url, content)
+
+
 class WashingtonAttorneysScraper(AttorneysScraper):
     @staticmethod
     def combine_details(attorneys: pd.DataFrame,
                         details: pd.DataFrame) -> pd.DataFrame:
-        return attorneys.join(details['admit_date','email'])
+        details = details.reindex(columns=['admit_date', 'email'])
+        return attorneys.join(details, on='href')
 
 
 class WashingtonAttorneyDetails(DetailsScraper): 
@@ -98,22 +98,32 @@ class WashingtonAttorneyDetails(DetailsScraper):
         details = attorney_details(page_url)
         return details
 
+    def _parse_page_details(self, page_url, content) -> Tuple[str, dict]:
+        return parse_attorney_details(page_url, content)
+
+
+def make_scraper(cache_path, **kwargs) -> AttorneysScraper:
+    """The Washington scraper, kwargs are those of AttorneysScraper"""
+    return WashingtonAttorneysScraper(cache_path=cache_path, name='washington',
+                                      list_scraper=WashingtonListByLetters,
+                                      details_scraper=WashingtonAttorneyDetails,
+                                      hosts=[host], **kwargs)
+
 
-def main(cache, output):
-    scraper = WashingtonAttorneysScraper(cache_path=cache, 
-                               name='washington', 
-                               list_scraper=WashingtonListByLetters,
-                               details_scraper=WashingtonAttorneyDetails, 
-                               )
+def main(cache, output, stream=False, prometheus=None, **kwargs):
+    """Scrapes into output, kwargs are those of AttorneysScraper"""
+    scraper = make_scraper(cache, **kwargs)
     print("scraper created")
-    attorneys = scraper.scrape()
-    attorneys.to_csv(output)
+    write_scraped(scraper, output, stream=stream, prometheus=prometheus)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('cache')
-    parser.add_argument('output')
+    parser.add_argument('output',
+                        help='csv file, parquet if it ends with .parquet, '
+                             'or json lines if it ends with .jsonl')
+    add_scraper_arguments(parser)
     args = parser.parse_args()
     print("getting to main")
-    main(args.cache, args.output)
+    main(**vars(args))
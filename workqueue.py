@@ -0,0 +1,162 @@
+import contextlib
+import os
+import socket
+import sqlite3
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+
+def worker_name() -> str:
+    """Identifies this worker process in the leases it holds"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class WorkQueue:
+    """
+    Work units leased to workers on any number of nodes, backed by one
+    SQLite file they share. A lease expires after lease_timeout seconds,
+    after which the unit goes to the next worker asking for work, so the
+    units of a crashed worker are not lost. Completed units keep their
+    result, which any node can read back to merge.
+
+    The file uses SQLite's rollback journal rather than WAL, which needs
+    shared memory and does not work across hosts; it must live on a
+    filesystem with working locks.
+    """
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Write locked from the start, so that two workers reading
+        # pending units never lease the same ones
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    def add(self, queue, units: Iterable[str]):
+        """Adds units to the queue, ignoring those already in it"""
+        with self._transaction():
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO units (queue, unit) VALUES (?, ?)',
+                [(queue, unit) for unit in units])
+
+    def lease(self, queue, count: int = 1) -> List[str]:
+        """
+        Leases up to count pending units, or units whose lease expired.
+        An expired unit already leased max_attempts times is marked failed
+        instead, as its workers keep dying on it.
+        """
+        now = time.time()
+        with self._transaction():
+            self._conn.execute(
+                "UPDATE units SET state = 'failed', error = COALESCE(error, "
+                "'lease expired') WHERE queue = ? AND state = 'leased' "
+                "AND expires_at < ? AND attempts >= ?",
+                (queue, now, self.max_attempts))
+            rows = self._conn.execute(
+                "SELECT unit FROM units WHERE queue = ? "
+                "AND state IN ('pending', 'leased') "
+                "AND (state = 'pending' OR expires_at < ?) LIMIT ?",
+                (queue, now, count)).fetchall()
+            units = [unit for unit, in rows]
+            self._conn.executemany(
+                "UPDATE units SET state = 'leased', owner = ?, expires_at = ?, "
+                "attempts = attempts + 1 WHERE queue = ? AND unit = ?",
+                [(self.worker, now + self.lease_timeout, queue, unit)
+                 for unit in units])
+        return units
+
+    def renew(self, queue, units: Iterable[str]):
+        """Extends the leases this worker holds on units"""
+        with self._transaction():
+            self._conn.executemany(
+                "UPDATE units SET expires_at = ? WHERE queue = ? AND unit = ? "
+                "AND state = 'leased' AND owner = ?",
+                [(time.time() + self.lease_timeout, queue, unit, self.worker)
+                 for unit in units])
+
+    def complete(self, queue, results: Iterable[Tuple[str, Optional[str]]]):
+        """Records the results of units, even if their lease expired"""
+        with self._transaction():
+            self._conn.executemany(
+                "UPDATE units SET state = 'done', result = ?, error = NULL "
+                "WHERE queue = ? AND unit = ?",
+                [(result, queue, unit) for unit, result in results])
+
+    def fail(self, queue, unit, error: str):
+        """
+        Gives a unit back to be leased again, or marks it failed for good
+        once it was leased max_attempts times
+        """
+        with self._transaction():
+            self._conn.execute(
+                "UPDATE units SET state = CASE WHEN attempts >= ? "
+                "THEN 'failed' ELSE 'pending' END, error = ? "
+                "WHERE queue = ? AND unit = ?",
+                (self.max_attempts, error, queue, unit))
+
+    def unfinished(self, queue) -> int:
+        """Number of units pending or leased"""
+        count, = self._conn.execute(
+            "SELECT COUNT(*) FROM units WHERE queue = ? "
+            "AND state IN ('pending', 'leased')", (queue,)).fetchone()
+        return count
+
+    def counts(self, queue) -> dict:
+        rows = self._conn.execute(
+            'SELECT state, COUNT(*) FROM units WHERE queue = ? GROUP BY state',
+            (queue,))
+        return dict(rows.fetchall())
+
+    def results(self, queue) -> Iterator[Tuple[str, str]]:
+        """Yields the (unit, result) of every completed unit"""
+        rows = self._conn.execute(
+            "SELECT unit, result FROM units WHERE queue = ? AND state = 'done'",
+            (queue,))
+        yield from rows
+
+    def drain(self, queue, process, batch_size: int = 1,
+              poll_interval: float = 5.0):
+        """
+        Leases batches of units and hands them to process, which completes
+        or fails them, until no unit of the queue is pending or leased.
+        Waits for the leases of other workers, which may expire.
+        """
+        while True:
+            units = self.lease(queue, batch_size)
+            if len(units) > 0:
+                process(units)
+            elif self.unfinished(queue) == 0:
+                return
+            else:
+                time.sleep(poll_interval)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __init__(self, path, lease_timeout: float = 600.0,
+                 max_attempts: int = 5, worker: Optional[str] = None):
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.worker = worker or worker_name()
+        # Transactions are managed explicitly, see `_transaction`
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=DELETE')
+        with self._transaction():
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS units ('
+                'queue TEXT NOT NULL, unit TEXT NOT NULL, '
+                "state TEXT NOT NULL DEFAULT 'pending', owner TEXT, "
+                'expires_at REAL, attempts INTEGER NOT NULL DEFAULT 0, '
+                'result TEXT, error TEXT, PRIMARY KEY (queue, unit))')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS units_state '
+                               'ON units (queue, state)')